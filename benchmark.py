@@ -0,0 +1,312 @@
+"""
+Micro-benchmarks for the inpainting network.
+Usage: python benchmark.py --bench attention [--cuda]
+"""
+
+import copy
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from data.dataset import Dataset
+from data.mask_bank import build_mask_bank
+from model.networks import Generator, ContextualAttention
+from trainer import Trainer
+from utils.tools import get_config, random_bbox, mask_image, local_patch, _slice_patches, _index_patches
+
+parser = ArgumentParser()
+parser.add_argument('--bench', type=str, default='attention',
+                    help="which benchmark to run: attention | generator | fuse | branches | amp | dis | checkpoint | local_patch | masks | loader")
+parser.add_argument('--cuda', action='store_true', help='run on the GPU')
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--memory_budget', type=int, default=256,
+                    help='score tile budget in MB for tiled attention')
+parser.add_argument('--image_size', type=int, default=256)
+parser.add_argument('--config', type=str, default='configs/config.yaml',
+                    help='training configuration for the training benchmarks')
+parser.add_argument('--channels_last', action='store_true',
+                    help='also switch the fused generator to the channels_last memory format')
+parser.add_argument('--data_path', type=str, default='',
+                    help='image directory of the loader benchmark, defaults to train_data_path')
+parser.add_argument('--num_workers', type=int, default=4, help='DataLoader workers of the loader benchmark')
+
+
+def timeit(fn, repeat, cuda):
+    """Return the mean wall time of fn() in seconds, after one warm-up call."""
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat
+
+
+def center_mask(batch_size, size, cuda):
+    mask = torch.zeros(batch_size, 1, size, size)
+    mask[:, :, size // 4:size * 3 // 4, size // 4:size * 3 // 4] = 1.
+    return mask.cuda() if cuda else mask
+
+
+def bench_attention(args):
+    """Compare the ContextualAttention engines and modes at 256, 512 and 1024 px inputs."""
+    for size in [256, 512, 1024]:
+        # the attention branch of FineGenerator works at 1/4 of the image size
+        f = torch.randn(args.batch_size, 128, size // 4, size // 4)
+        if args.cuda:
+            f = f.cuda()
+        mask = center_mask(args.batch_size, size, args.cuda)
+        modes = [('conv', {'engine': 'conv'}),
+                 ('gemm', {'engine': 'gemm'}),
+                 ('tiled', {'memory_budget': args.memory_budget})]
+        for name, kwargs in modes:
+            attention = ContextualAttention(ksize=3, stride=1, rate=2, fuse_k=3, softmax_scale=10,
+                                            fuse=True, use_cuda=args.cuda, **kwargs)
+            try:
+                with torch.no_grad():
+                    t = timeit(lambda: attention(f, f, mask, return_flow=False), args.repeat, args.cuda)
+                print('attention {}px {}: {:.1f} ms'.format(size, name, t * 1000))
+            except RuntimeError as e:  # most likely out of memory
+                print('attention {}px {}: failed ({})'.format(size, name, e))
+
+
+def build_generator(args):
+    netG = Generator({'input_dim': 3, 'ngf': 32}, args.cuda)
+    if args.cuda:
+        netG = netG.cuda()
+    return netG.eval()
+
+
+def bench_generator(args):
+    """Time a full Generator forward pass, by default on the CPU."""
+    netG = build_generator(args)
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    if args.cuda:
+        x = x.cuda()
+    mask = center_mask(args.batch_size, args.image_size, args.cuda)
+    with torch.no_grad():
+        t = timeit(lambda: netG(x, mask, return_flow=False), args.repeat, args.cuda)
+    print('generator {}px batch {} on {}: {:.1f} ms'.format(
+        args.image_size, args.batch_size, 'cuda' if args.cuda else 'cpu', t * 1000))
+
+
+def bench_fuse(args):
+    """Compare the Generator before and after fuse_for_inference()."""
+    netG = build_generator(args)
+    fused = copy.deepcopy(netG).fuse_for_inference(channels_last=args.channels_last)
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    if args.cuda:
+        x = x.cuda()
+    mask = center_mask(args.batch_size, args.image_size, args.cuda)
+    with torch.no_grad():
+        diff = (netG(x, mask, return_flow=False)[1] - fused(x, mask, return_flow=False)[1]).abs().max()
+        t = timeit(lambda: netG(x, mask, return_flow=False), args.repeat, args.cuda)
+        t_fused = timeit(lambda: fused(x, mask, return_flow=False), args.repeat, args.cuda)
+    print('generator: {:.1f} ms, fused: {:.1f} ms ({:.1%} faster), max abs diff {:.3e}'.format(
+        t * 1000, t_fused * 1000, 1 - t_fused / t, diff.item()))
+
+
+def bench_branches(args):
+    """Compare the FineGenerator branch modes, see Generator.set_branch_mode."""
+    netG = build_generator(args)
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    if args.cuda:
+        x = x.cuda()
+    mask = center_mask(args.batch_size, args.image_size, args.cuda)
+    with torch.no_grad():
+        reference = netG(x, mask, return_flow=False)[1]
+        for concat_first, concurrent in [(False, False), (True, False), (False, True), (True, True)]:
+            netG.set_branch_mode(concat_first, concurrent)
+            diff = (netG(x, mask, return_flow=False)[1] - reference).abs().max()
+            t = timeit(lambda: netG(x, mask, return_flow=False), args.repeat, args.cuda)
+            print('concat_first={} concurrent={}: {:.1f} ms, max abs diff {:.3e}'.format(
+                concat_first, concurrent, t * 1000, diff.item()))
+
+
+def training_config(args):
+    """The training configuration, resized to the benchmark arguments."""
+    config = get_config(args.config)
+    config['cuda'] = args.cuda
+    config['gpu_ids'] = [0]
+    config['batch_size'] = args.batch_size
+    config['image_shape'] = [args.image_size, args.image_size, 3]
+    config['mask_shape'] = [args.image_size // 2, args.image_size // 2]
+    config['max_delta_shape'] = [args.image_size // 8, args.image_size // 8]
+    return config
+
+
+def train_step(trainer, config, ground_truth, compute_g_loss=True):
+    bboxes = random_bbox(config, batch_size=ground_truth.size(0))
+    x, mask = mask_image(ground_truth, bboxes, config)
+    trainer.train_step(x, bboxes, mask, ground_truth, compute_g_loss, False)
+
+
+def bench_amp(args):
+    """Training throughput and peak memory in fp32 and with mixed precision."""
+    config = training_config(args)
+    ground_truth = torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2. - 1.
+    if args.cuda:
+        ground_truth = ground_truth.cuda()
+    for amp in ['none', 'fp16', 'bf16'] if args.cuda else ['none', 'bf16']:
+        config['amp'] = amp
+        trainer = Trainer(config)
+        if args.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        t = timeit(lambda: train_step(trainer, config, ground_truth), args.repeat, args.cuda)
+        memory = '%.0f MB' % (torch.cuda.max_memory_allocated() / 2**20) if args.cuda else 'n/a'
+        print('amp {}: {:.2f} batches/s, peak memory {}'.format(amp, 1. / t, memory))
+        del trainer
+
+
+def bench_dis(args):
+    """Critic passes of a generator iteration, before and after sharing them between the D and G losses."""
+    config = training_config(args)
+    trainer = Trainer(config)
+    ground_truth = torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2. - 1.
+    if args.cuda:
+        ground_truth = ground_truth.cuda()
+    bboxes = random_bbox(config, batch_size=args.batch_size)
+    x, mask = mask_image(ground_truth, bboxes, config)
+    x2 = trainer.netG(x, mask, return_flow=False)[1]
+    x2_inpaint = x2 * mask + x * (1. - mask)
+    # (discriminator, real, fake, loss weight) of every critic
+    critics = [(trainer.localD, *local_patch([ground_truth, x2_inpaint], bboxes), 1.),
+               (trainer.globalD, ground_truth, x2_inpaint, config['global_wgan_loss_alpha'])]
+
+    def separate():
+        # the D loss on detached fakes, then the G loss on real and fake images again
+        wgan_g = 0.
+        for netD, real, fake, alpha in critics:
+            trainer.dis_forward(netD, real, fake.detach())
+            _, fake_pred = trainer.dis_forward(netD, real, fake)
+            wgan_g = wgan_g - torch.mean(fake_pred) * alpha
+        return wgan_g
+
+    def shared():
+        wgan_g = 0.
+        for netD, real, fake, alpha in critics:
+            _, fake_pred = trainer.dis_forward(netD, real, fake)
+            wgan_g = wgan_g - torch.mean(fake_pred) * alpha
+        return wgan_g
+
+    diff = (separate() - shared()).abs().item()
+    t_separate = timeit(separate, args.repeat, args.cuda)
+    t_shared = timeit(shared, args.repeat, args.cuda)
+    t_step = timeit(lambda: train_step(trainer, config, ground_truth, compute_g_loss=True), args.repeat, args.cuda)
+    print('critic passes: {:.1f} ms separate, {:.1f} ms shared ({:.1%} faster), '
+          'wgan_g abs diff {:.3e}'.format(t_separate * 1000, t_shared * 1000, 1 - t_shared / t_separate, diff))
+    print('generator iteration: {:.1f} ms'.format(t_step * 1000))
+
+
+def bench_checkpoint(args):
+    """Training step time and peak memory for the activation checkpointing segments."""
+    config = training_config(args)
+    ground_truth = torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2. - 1.
+    if args.cuda:
+        ground_truth = ground_truth.cuda()
+    for segments in [[], ['coarse_atrous', 'fine_atrous'], ['attention'],
+                     ['coarse_atrous', 'fine_atrous', 'attention']]:
+        config['netG']['checkpoint'] = segments
+        trainer = Trainer(config)
+        if args.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        t = timeit(lambda: train_step(trainer, config, ground_truth), args.repeat, args.cuda)
+        memory = '%.0f MB' % (torch.cuda.max_memory_allocated() / 2**20) if args.cuda else 'n/a'
+        print('checkpoint {}: {:.1f} ms/step, peak memory {}'.format(segments or 'none', t * 1000, memory))
+        del trainer
+
+
+def bench_local_patch(args):
+    """Crop the discriminator patches of a batch by slicing every sample and with one indexing per tensor."""
+    config = training_config(args)
+    tensors = [torch.randn(args.batch_size, 3, args.image_size, args.image_size) for _ in range(3)]
+    if args.cuda:
+        tensors = [t.cuda() for t in tensors]
+    bboxes = random_bbox(config, batch_size=args.batch_size)
+
+    diff = max((a - b).abs().max().item()
+               for a, b in zip(_slice_patches(tensors, bboxes), _index_patches(tensors, bboxes)))
+    t_slice = timeit(lambda: _slice_patches(tensors, bboxes), args.repeat, args.cuda)
+    t_index = timeit(lambda: _index_patches(tensors, bboxes), args.repeat, args.cuda)
+    print('local patches of 3 tensors at batch {}: sliced {:.2f} ms, indexed {:.2f} ms '
+          '(local_patch uses {}), max abs diff {:.1e}'.format(
+              args.batch_size, t_slice * 1000, t_index * 1000, 'indexed' if args.cuda else 'sliced', diff))
+
+
+def bench_masks(args):
+    """Free-form masks of a batch, drawn on the fly and sampled from a mask bank."""
+    config = training_config(args)
+    config['mask_type'] = 'free_form'
+    ground_truth = torch.zeros(args.batch_size, 3, args.image_size, args.image_size)
+    if args.cuda:
+        ground_truth = ground_truth.cuda()
+    bboxes = random_bbox(config, batch_size=args.batch_size)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mask_bank = build_mask_bank(os.path.join(tmp_dir, 'masks.npy'), 1024, *config['mask_shape'], config['brush'])
+        t_draw = timeit(lambda: mask_image(ground_truth, bboxes, config), args.repeat, args.cuda)
+        t_bank = timeit(lambda: mask_image(ground_truth, bboxes, config, mask_bank=mask_bank), args.repeat, args.cuda)
+        del mask_bank
+    print('free-form masks at batch {}: drawn {:.1f} ms, mask bank {:.1f} ms'.format(
+        args.batch_size, t_draw * 1000, t_bank * 1000))
+
+
+def bench_loader(args):
+    """Images/s of the training DataLoader, with float and uint8 images, with and without random crops."""
+    config = get_config(args.config)
+    for random_crop in [True, False]:
+        for uint8 in [False, True]:
+            dataset = Dataset(data_path=args.data_path or config['train_data_path'],
+                              with_subfolder=config['data_with_subfolder'],
+                              image_shape=config['image_shape'],
+                              random_crop=random_crop,
+                              uint8=uint8)
+            loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=args.batch_size, shuffle=True,
+                                                 num_workers=args.num_workers, drop_last=True)
+            # the first batch includes the start of the workers
+            iterable_loader = iter(loader)
+            next(iterable_loader)
+            start = time.time()
+            num_batches = min(args.repeat, len(loader) - 1)
+            for _ in range(num_batches):
+                next(iterable_loader)
+            speed = num_batches * args.batch_size / (time.time() - start)
+            print('loader random_crop={} uint8={}: {:.1f} images/s, {:.1f} images/s per worker'.format(
+                random_crop, uint8, speed, speed / max(1, args.num_workers)))
+            del iterable_loader
+
+
+def main():
+    args = parser.parse_args()
+    print("Arguments: {}".format(args))
+    if args.bench == 'attention':
+        bench_attention(args)
+    elif args.bench == 'generator':
+        bench_generator(args)
+    elif args.bench == 'fuse':
+        bench_fuse(args)
+    elif args.bench == 'branches':
+        bench_branches(args)
+    elif args.bench == 'amp':
+        bench_amp(args)
+    elif args.bench == 'dis':
+        bench_dis(args)
+    elif args.bench == 'checkpoint':
+        bench_checkpoint(args)
+    elif args.bench == 'local_patch':
+        bench_local_patch(args)
+    elif args.bench == 'masks':
+        bench_masks(args)
+    elif args.bench == 'loader':
+        bench_loader(args)
+    else:
+        raise NotImplementedError('Unsupported benchmark: {}'.format(args.bench))
+
+
+if __name__ == '__main__':
+    main()
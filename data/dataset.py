@@ -8,7 +8,14 @@ import torchvision.transforms as transforms
 
 
 class Dataset(data.Dataset):
-    def __init__(self, data_path, image_shape, with_subfolder=False, random_crop=True, return_name=False):
+    def __init__(self, data_path, image_shape, with_subfolder=False, random_crop=True, return_name=False,
+                 uint8=False):
+        """
+        Args:
+            uint8: Return [3, H, W] uint8 images, to copy 4 times less data
+                and leave the conversion to the device, see
+                utils.tools.normalize_uint8. Float [-1, 1] images otherwise.
+        """
         super(Dataset, self).__init__()
         if with_subfolder:
             self.samples = self._find_samples_in_subfolders(data_path)
@@ -18,22 +25,33 @@ class Dataset(data.Dataset):
         self.image_shape = image_shape[:-1]
         self.random_crop = random_crop
         self.return_name = return_name
+        self.uint8 = uint8
+        # the transforms are built once and shared by all the items
+        self.upscale = transforms.Resize(min(self.image_shape))
+        self.resize = transforms.Resize(self.image_shape)
+        self.crop = transforms.RandomCrop(self.image_shape)
+        self.to_tensor = transforms.PILToTensor() if uint8 else transforms.ToTensor()
+        # the images are resized to image_shape without random_crop, large
+        # JPEGs can then be decoded at a reduced scale (random crops keep
+        # the full resolution)
+        self.draft_size = None if random_crop else (self.image_shape[1], self.image_shape[0])
 
     def __getitem__(self, index):
         path = os.path.join(self.data_path, self.samples[index])
-        img = default_loader(path)
+        img = default_loader(path, self.draft_size)
 
         if self.random_crop:
             imgw, imgh = img.size
             if imgh < self.image_shape[0] or imgw < self.image_shape[1]:
-                img = transforms.Resize(min(self.image_shape))(img)
-            img = transforms.RandomCrop(self.image_shape)(img)
+                img = self.upscale(img)
+            img = self.crop(img)
         else:
-            img = transforms.Resize(self.image_shape)(img)
-            img = transforms.RandomCrop(self.image_shape)(img)
+            img = self.resize(img)
+            img = self.crop(img)
 
-        img = transforms.ToTensor()(img)  # turn the image to a tensor
-        img = normalize(img)
+        img = self.to_tensor(img)  # turn the image to a tensor
+        if not self.uint8:
+            img = normalize(img)
 
         if self.return_name:
             return self.samples[index], img
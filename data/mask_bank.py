@@ -0,0 +1,110 @@
+"""
+Bank of precomputed free-form masks, stored as a packed-bit memory-mapped file.
+Build it once with:
+    python -m data.mask_bank --config configs/config.yaml --output masks.npy --num_masks 50000
+and set mask_bank: masks.npy with mask_type: free_form in the config.
+"""
+
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from utils.tools import get_config, brush_stroke_mask, mask_image, random_bbox
+
+
+class MaskBank(object):
+    """Random free-form masks sampled from a bank built by build_mask_bank.
+
+    The masks are kept as bits in a memory-mapped [M, H, W / 8] uint8 .npy
+    file, a 128x128 mask takes 2 KB. Sampling reads the packed rows of the
+    chosen masks, unpacks them on the target device and applies a random
+    flip/rotation to each, so the bank is augmented 8 times (4 times for
+    non-square masks).
+    """
+
+    def __init__(self, path):
+        super(MaskBank, self).__init__()
+        self.masks = np.load(path, mmap_mode='r')
+        self.height = self.masks.shape[1]
+        self.width = self.masks.shape[2] * 8
+        self.bits = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+    def __len__(self):
+        return self.masks.shape[0]
+
+    def sample(self, n, generator=None, device=None):
+        """Sample n masks.
+
+        Args:
+            generator: torch.Generator for reproducible masks.
+            device: Device of the masks, defaults to the CPU.
+        Returns:
+            torch.tensor: [n, 1, height, width] float32 masks, 1 in the holes
+        """
+        gen_device = generator.device if generator is not None else None
+        indices = torch.randint(len(self), (n,), generator=generator, device=gen_device)
+        flips = torch.rand(n, 3, generator=generator, device=gen_device) < 0.5
+        # the order of the random masks does not matter, sorted reads of the file are faster
+        packed = torch.from_numpy(self.masks[np.sort(indices.cpu().numpy())])
+        # 8 times less data to copy than the unpacked masks
+        packed = packed.to(device)
+        masks = (packed.unsqueeze(dim=-1) & self.bits.to(packed.device)) > 0
+        masks = masks.view(n, 1, self.height, self.width).to(torch.float32)
+        flips = flips.to(masks.device).view(n, 3, 1, 1, 1)
+        masks = torch.where(flips[:, 0], masks.flip(2), masks)
+        masks = torch.where(flips[:, 1], masks.flip(3), masks)
+        if self.height == self.width:
+            # with the flips, the transposition gives the 90 degree rotations
+            masks = torch.where(flips[:, 2], masks.transpose(2, 3), masks)
+        # the transposition leaves transposed strides
+        return masks.contiguous()
+
+
+def build_mask_bank(path, num_masks, height, width, brush, seed=0, chunk=1024):
+    """Draw num_masks brush stroke masks (see brush_stroke_mask) into a packed-bit .npy file."""
+    assert width % 8 == 0, 'The mask width has to be a multiple of 8'
+    rng = np.random.RandomState(seed)
+    masks = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(num_masks, height, width // 8))
+    for i in range(0, num_masks, chunk):
+        strokes = np.stack([brush_stroke_mask(height, width, brush, rng) for _ in range(min(chunk, num_masks - i))])
+        masks[i:i + len(strokes)] = np.packbits(strokes, axis=-1)
+    masks.flush()
+    return MaskBank(path)
+
+
+def test_mask_bank(path='/tmp/test_mask_bank.npy'):
+    brush = {'num_strokes': [1, 4], 'num_vertex': [4, 12], 'width': [8, 24]}
+    bank = build_mask_bank(path, 16, 128, 128, brush)
+    expected = brush_stroke_mask(128, 128, brush, np.random.RandomState(0))
+    assert np.array_equal(np.unpackbits(bank.masks[0], axis=-1), expected), 'The mask bank does not round trip'
+    masks = bank.sample(48)
+    assert masks.size() == (48, 1, 128, 128), 'MaskBank.sample has a wrong shape'
+    assert ((masks == 0) | (masks == 1)).all(), 'MaskBank.sample is not binary'
+    assert masks.is_contiguous(), 'MaskBank.sample is not contiguous'
+
+    # the training path: strokes pasted into the boxes of the batch
+    config = {'image_shape': [256, 256, 3], 'mask_shape': [128, 128], 'margin': [0, 0],
+              'mask_batch_same': False, 'max_delta_shape': [32, 32], 'mask_type': 'free_form', 'brush': brush}
+    x = torch.ones(48, 3, 256, 256)
+    bboxes = random_bbox(config, batch_size=48)
+    result, mask = mask_image(x, bboxes, config, mask_bank=bank)
+    assert mask.size() == (48, 1, 256, 256), 'mask_image with a mask bank has a wrong shape'
+    for (t, l, h, w), mask_i in zip(bboxes.tolist(), mask):
+        assert mask_i.sum() == mask_i[:, t:t + h, l:l + w].sum(), 'The strokes are outside of their box'
+    assert torch.equal(result, x * (1. - mask)), 'mask_image does not erase the strokes'
+    return masks
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/config.yaml',
+                        help='training configuration, for mask_shape and brush')
+    parser.add_argument('--output', type=str, default='masks.npy')
+    parser.add_argument('--num_masks', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    config = get_config(args.config)
+    height, width = config['mask_shape']
+    bank = build_mask_bank(args.output, args.num_masks, height, width, config['brush'], seed=args.seed)
+    print('Built a bank of {} {}x{} masks in {}'.format(len(bank), height, width, args.output))
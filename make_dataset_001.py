@@ -115,7 +115,7 @@ class FolderWithPath(ImageNetSubsetDataset):
             input_mask_batch = mask.unsqueeze(0).cuda()
             input_mask_batch = 1 - input_mask_batch
 
-            x1, x2, offset_flow = netG(input_batch, input_mask_batch)
+            x1, x2, offset_flow = netG(input_batch, input_mask_batch, return_flow=False)
             inpainted_result = x2 * (input_mask_batch.cuda()) + input_batch * (1.0 - input_mask_batch.cuda())
             inpainted_result = inpainted_result[0].cpu()
             unnormalized_image = trnF.to_pil_image(((inpainted_result / 2) + 0.5).clamp(0, 1))
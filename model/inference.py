@@ -0,0 +1,498 @@
+import math
+import queue
+import threading
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+from model.networks import Generator
+from utils.tools import get_model_list, default_loader, normalize, random_bbox, mask_image, \
+    mask_components, mask_bboxes, reduce_mean, reduce_sum
+
+
+class InpaintEngine(object):
+    """Keep a trained Generator resident and inpaint images in micro-batches.
+
+    The checkpoint is loaded once, so any number of requests can be pushed
+    through the same engine without paying the model loading cost again.
+    Args:
+        config: Training configuration, see configs/config.yaml.
+        checkpoint_path: Directory with the gen_*.pt checkpoints.
+        iteration: Checkpoint iteration to load, 0 for the latest one.
+        batch_size: Number of images per forward pass.
+        device: torch.device to run on, defaults to the GPU if config['cuda'] is set.
+        fuse: Apply Generator.fuse_for_inference() after loading the weights.
+        native_size: Inpaint images at their own size instead of resizing
+            and cropping them to config['image_shape'].
+        cascade: 'full' runs both stages, 'coarse' only the coarse one and
+            'adaptive' skips the fine stage for the images whose hole covers
+            less than min_hole_area of the image, or whose coarse output
+            differs from the known pixels around the hole by less than
+            max_coarse_error on average. Either threshold can be None.
+        attention: ContextualAttention options overriding config['netG']['attention'],
+            e.g. {'memory_budget': 256} to inpaint 2K images on the CPU.
+    """
+    def __init__(self, config, checkpoint_path, iteration=0, batch_size=8, device=None, fuse=False,
+                 native_size=False, cascade='full', min_hole_area=0.01, max_coarse_error=None,
+                 attention=None):
+        assert cascade in ['full', 'coarse', 'adaptive'], "Unsupported cascade: {}".format(cascade)
+        self.config = config
+        self.batch_size = batch_size
+        self.cascade = cascade
+        self.min_hole_area = min_hole_area
+        self.max_coarse_error = max_coarse_error
+        if device is None:
+            device = 'cuda' if config['cuda'] and torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+
+        # the attention options are not parameters, the checkpoint loads with any of them
+        netG_config = dict(config['netG'])
+        netG_config['attention'] = dict(netG_config.get('attention') or {}, **(attention or {}))
+        self.netG = Generator(netG_config, self.device.type == 'cuda')
+        last_model_name = get_model_list(checkpoint_path, "gen", iteration=iteration)
+        self.netG.load_state_dict(torch.load(last_model_name, map_location=self.device))
+        self.netG.to(self.device)
+        self.netG.eval()
+        if fuse:
+            self.netG.fuse_for_inference()
+        self.iteration = int(last_model_name[-11:-3])
+        print("Resume from {} at iteration {}".format(checkpoint_path, self.iteration))
+
+        image_size = config['image_shape'][:-1]
+        if native_size:
+            self.image_transform = transforms.ToTensor()
+        else:
+            self.image_transform = transforms.Compose([transforms.Resize(image_size),
+                                                       transforms.CenterCrop(image_size),
+                                                       transforms.ToTensor()])
+        self.mask_transform = self.image_transform
+
+    def load(self, image, mask=None):
+        """Turn an (image, mask) pair into the network input.
+
+        Args:
+            image: Image path, PIL image or [3, H, W] tensor in [-1, 1].
+            mask: Mask path, PIL image, [1, H, W] tensor with 1 in the hole,
+                or None for a random mask.
+        Returns:
+            tuple: (masked image [3, H, W], mask [1, H, W])
+        """
+        if isinstance(image, str):
+            image = default_loader(image)
+        if not torch.is_tensor(image):
+            image = normalize(self.image_transform(image))
+        if mask is None:
+            bboxes = random_bbox(self.config, batch_size=1)
+            x, mask = mask_image(image.unsqueeze(dim=0), bboxes, self.config)
+            return x[0], mask[0]
+        if isinstance(mask, str):
+            mask = default_loader(mask)
+        if not torch.is_tensor(mask):
+            mask = self.mask_transform(mask)[0].unsqueeze(dim=0)
+        return image * (1. - mask), mask
+
+    def inpaint(self, pairs, stats=None):
+        """Inpaint a list of (image, mask) pairs, see `load` for the accepted types.
+
+        Args:
+            stats: Optional list, extended with one `inpaint_batch` stats
+                dict per pair.
+        Returns:
+            list: Inpainted images, [3, H, W] tensors in [-1, 1] on the CPU.
+        """
+        results = []
+        for i in range(0, len(pairs), self.batch_size):
+            inputs = [self.load(image, mask) for image, mask in pairs[i:i + self.batch_size]]
+            outputs = [None] * len(inputs)
+            outputs_stats = [None] * len(inputs)
+            # only images of the same size can share a forward pass
+            sizes = {}
+            for j, (x, _) in enumerate(inputs):
+                sizes.setdefault(tuple(x.size()), []).append(j)
+            for indices in sizes.values():
+                x = torch.stack([inputs[j][0] for j in indices], dim=0)
+                mask = torch.stack([inputs[j][1] for j in indices], dim=0)
+                batch_stats = []
+                for j, result in zip(indices, self.inpaint_batch(x, mask, batch_stats).cpu()):
+                    outputs[j] = result
+                for j, sample_stats in zip(indices, batch_stats):
+                    outputs_stats[j] = sample_stats
+            results.extend(outputs)
+            if stats is not None:
+                stats.extend(outputs_stats)
+        return results
+
+    def inpaint_batch(self, x, mask, stats=None):
+        """Inpaint a batch of masked images, in micro-batches of batch_size.
+
+        Args:
+            x: Masked images, [N, 3, H, W] in [-1, 1].
+            mask: Masks, [N, 1, H, W] with 1 in the hole.
+            stats: Optional list, extended with a dict per image with the
+                'path' taken ('coarse' or 'fine'), and for the adaptive
+                cascade the 'hole_area' and 'coarse_error' it was based on.
+        Returns:
+            torch.tensor: x with the hole filled in, on the engine device
+        """
+        results = []
+        with torch.no_grad():
+            for xi, mi in zip(torch.split(x, self.batch_size), torch.split(mask, self.batch_size)):
+                xi = xi.to(self.device)
+                mi = mi.to(self.device)
+                batch_stats = [{'path': 'coarse' if self.cascade == 'coarse' else 'fine'}
+                               for _ in range(xi.size(0))]
+                if self.cascade == 'adaptive':
+                    skip_fine = lambda xp, x1, mp: self.skip_fine(xp, x1, mp, batch_stats)
+                else:
+                    skip_fine = self.cascade == 'coarse'
+                x1, x2, _ = self.netG(xi, mi, return_flow=False, skip_fine=skip_fine)
+                results.append(x2 * mi + xi * (1. - mi))
+                if stats is not None:
+                    stats.extend(batch_stats)
+        return torch.cat(results, dim=0)
+
+    def skip_fine(self, x, x_stage1, mask, stats, ring=4):
+        """Adaptive cascade policy, select the images that the coarse stage is enough for.
+
+        The coarse stage reconstructs the known pixels as well, so its error
+        on a ring of `ring` pixels around the hole is a cheap confidence
+        estimate for the hole.
+        Returns:
+            torch.tensor: [N] bool, True for the images skipping the fine stage
+        """
+        mask = mask.to(x)
+        hole_area = reduce_mean(mask, axis=[1, 2, 3])
+        border = F.max_pool2d(mask, 2 * ring + 1, stride=1, padding=ring) - mask
+        coarse_error = reduce_sum(torch.abs(x_stage1 - x) * border, axis=[1, 2, 3]) / \
+            torch.clamp(reduce_sum(border, axis=[1, 2, 3]) * x.size(1), min=1.)
+        skip = torch.zeros_like(hole_area, dtype=torch.bool)
+        if self.min_hole_area is not None:
+            skip = skip | (hole_area < self.min_hole_area)
+        if self.max_coarse_error is not None:
+            skip = skip | (coarse_error < self.max_coarse_error)
+        for sample_stats, area, error, coarse in zip(stats, hole_area.tolist(), coarse_error.tolist(),
+                                                     skip.tolist()):
+            sample_stats.update(path='coarse' if coarse else 'fine', hole_area=area, coarse_error=error)
+        return skip
+
+    def inpaint_roi(self, x, mask, context=2., feather=8, analysis_size=1024):
+        """Inpaint a large image by running the network only around its holes.
+
+        Every connected hole gets a square window of `context` times its
+        bounding box, at least the training size and at most the image. A
+        long or thin hole, such as a scratch across the frame, is covered
+        by several windows of `context` times its thickness instead, so it
+        does not turn into a full-frame, downscaled window.
+        Overlapping windows are merged into their bounding box, which is
+        grown back to a square. A window cut by an image side shorter than
+        it is padded to a square, so the content is never stretched when
+        the windows are resized to the (square) training size. They are
+        inpainted in one batch and blended back with a feathered edge, so
+        the cost follows the hole size instead of the image size.
+        Args:
+            x: Masked image, [3, H, W] in [-1, 1].
+            mask: Mask, [1, H, W] with 1 in the hole.
+            context: Window side over the longest side of the hole bounding box,
+                or over the hole thickness for long holes.
+            feather: Width in pixels of the blend outside of the hole.
+            analysis_size: Holes are found on the mask max-pooled to about this size.
+        Returns:
+            torch.tensor: inpainted image, [3, H, W] on the device of x
+        """
+        return self.inpaint_rois([(x, mask)], context, feather, analysis_size)[0]
+
+    def inpaint_rois(self, inputs, context=2., feather=8, analysis_size=1024):
+        """Inpaint the holes of many images, see `inpaint_roi`.
+
+        The images are split into one crop per (group of overlapping) holes
+        and the crops of all the images are packed into the same batches,
+        so images of any size share the forward passes and every crop only
+        attends to its own context.
+        Args:
+            inputs: List of (masked image [3, H, W], mask [1, H, W]) pairs,
+                as returned by `load`, of any sizes.
+        Returns:
+            list: inpainted images, [3, H, W] on the device of their input
+        """
+        size = self.config['image_shape'][:-1]
+        windows = []
+        crops_x = []
+        crops_mask = []
+        for x, mask in inputs:
+            windows.append(roi_windows(mask, context, max(size), analysis_size))
+            for t, l, h, w in windows[-1]:
+                xi = x[:, t:t + h, l:l + w].unsqueeze(dim=0)
+                mi = mask[:, t:t + h, l:l + w].unsqueeze(dim=0).to(x)
+                if h != w:
+                    # replicate the image and the hole up to a square
+                    side = max(h, w)
+                    xi = F.pad(xi, [0, side - w, 0, side - h], mode='replicate')
+                    mi = F.pad(mi, [0, side - w, 0, side - h], mode='replicate')
+                mi = resize_mask(mi, size)
+                xi = F.interpolate(xi, size=size, mode='bilinear', align_corners=False)
+                crops_x.append(xi * (1. - mi))
+                crops_mask.append(mi)
+        if not crops_x:
+            return [x for x, _ in inputs]
+        results = self.inpaint_batch(torch.cat(crops_x, dim=0), torch.cat(crops_mask, dim=0))
+
+        # scatter the crops back to their images
+        outputs = []
+        start = 0
+        for (x, mask), windows_i in zip(inputs, windows):
+            if windows_i:
+                results_i = []
+                for (t, l, h, w), result in zip(windows_i, results[start:start + len(windows_i)].to(x.device)):
+                    if h != w:
+                        # drop the padding of the square
+                        side = max(h, w)
+                        result = F.interpolate(result.unsqueeze(dim=0), size=(side, side), mode='bilinear',
+                                               align_corners=False)[0, :, :h, :w]
+                    results_i.append(result)
+                x = paste_windows(x, mask, windows_i, results_i, feather)
+                start += len(windows_i)
+            outputs.append(x)
+        return outputs
+
+    def inpaint_tiled(self, x, mask, tile_size=None, overlap=32, blend='cosine', queue_size=2):
+        """Inpaint an image of any size with overlapping tiles at its native resolution.
+
+        Only the tiles that intersect the mask are run, batch_size at a
+        time. A background thread cuts the tiles and hands them over through
+        a queue of at most queue_size batches, so besides the image and its
+        blending accumulators the memory does not grow with the image size.
+        Overlapping outputs are blended with linear or cosine weights.
+        Args:
+            x: Masked image, [3, H, W] in [-1, 1].
+            mask: Mask, [1, H, W] with 1 in the hole.
+            tile_size: Tile side, defaults to the training size.
+            overlap: Pixels shared by neighbouring tiles.
+            blend: 'linear' or 'cosine' weights over the overlap.
+            queue_size: Number of batches of tiles prepared ahead.
+        Returns:
+            torch.tensor: inpainted image, [3, H, W] on the device of x
+        """
+        if tile_size is None:
+            tile_size = max(self.config['image_shape'][:-1])
+        assert blend in ['linear', 'cosine'], "Unsupported blending: {}".format(blend)
+        assert 0 <= overlap < tile_size, "The overlap has to be smaller than the tiles"
+        height, width = x.size(-2), x.size(-1)
+        tiles = [(t, l) for t in tile_starts(height, tile_size, overlap)
+                 for l in tile_starts(width, tile_size, overlap)
+                 if mask[:, t:t + tile_size, l:l + tile_size].max() > 0]
+        if not tiles:
+            return x
+
+        batches = queue.Queue(maxsize=queue_size)
+        errors = []
+
+        def produce():
+            try:
+                for i in range(0, len(tiles), self.batch_size):
+                    batch = tiles[i:i + self.batch_size]
+                    xi = torch.stack([x[:, t:t + tile_size, l:l + tile_size] for t, l in batch], dim=0)
+                    mi = torch.stack([mask[:, t:t + tile_size, l:l + tile_size] for t, l in batch], dim=0)
+                    batches.put((batch, xi, mi))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                batches.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        acc = torch.zeros_like(x)
+        weight = x.new_zeros(1, height, width)
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            batch, xi, mi = item
+            for (t, l), result in zip(batch, self.inpaint_batch(xi, mi).to(x.device)):
+                h, w = result.size(-2), result.size(-1)
+                wi = tile_weight(t, l, h, w, height, width, overlap, blend).to(x)
+                acc[:, t:t + h, l:l + w] += wi * result
+                weight[:, t:t + h, l:l + w] += wi
+        producer.join()
+        if errors:
+            raise errors[0]
+        # the pixels of the skipped tiles are outside of the hole
+        return torch.where(weight > 0, acc / torch.clamp(weight, min=1e-8), x)
+
+
+def attention_options(args):
+    """ContextualAttention options given on the command line (see test_batch.py), the others come from the config."""
+    options = {'engine': args.attention_engine, 'masked_only': args.masked_only,
+               'chunk_size': args.chunk_size, 'memory_budget': args.memory_budget}
+    return {k: v for k, v in options.items() if v is not None}
+
+
+def tile_starts(size, tile_size, overlap):
+    """Offsets of the tiles covering size pixels, the last tile is aligned with the end."""
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    starts.append(size - tile_size)
+    return starts
+
+
+def tile_weight(t, l, h, w, height, width, overlap, blend):
+    """Blending weights of a tile, [1, h, w], ramping up on the sides shared with other tiles."""
+    return (blend_ramp(h, overlap, t > 0, t + h < height, blend).view(1, h, 1) *
+            blend_ramp(w, overlap, l > 0, l + w < width, blend).view(1, 1, w))
+
+
+def blend_ramp(size, overlap, start, end, blend):
+    """1D weights, ramping from 0 to 1 over the first and/or last overlap pixels."""
+    weight = torch.ones(size)
+    if overlap > 0:
+        ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+        if blend == 'cosine':
+            ramp = 0.5 - 0.5 * torch.cos(math.pi * ramp)
+        if start:
+            weight[:overlap] = ramp
+        if end:
+            weight[-overlap:] = torch.min(weight[-overlap:], ramp.flip(0))
+    return weight
+
+
+def roi_windows(mask, context, min_size, analysis_size=1024):
+    """Square context windows around the connected holes of a mask.
+
+    A hole gets one window of `context` times the longest side of its
+    bounding box, unless several windows of `context` times its thickness
+    (area over longest side) cover it with fewer pixels. So a long scratch
+    is split along its length instead of taking the whole frame.
+    Args:
+        mask: [1, H, W] tensor with 1 in the holes.
+    Returns:
+        list: (top, left, height, width) windows inside the image that do
+            not overlap, square unless cut by a shorter image side
+    """
+    height, width = mask.size(-2), mask.size(-1)
+    scale = max(1, int(math.ceil(max(height, width) / float(analysis_size))))
+    small = mask.view(1, 1, height, width).float()
+    if scale > 1:
+        small = F.max_pool2d(small, scale, ceil_mode=True)
+    labels = mask_components(small)
+    areas = torch.unique(labels, return_counts=True)[1][1:].tolist()
+    windows = []
+    for (t, l, h, w), area in zip(mask_bboxes(labels)[0], areas):
+        t, l, h, w = t * scale, l * scale, h * scale, w * scale
+        side = max(min_size, int(math.ceil(max(h, w) * context)))
+        window = clamp_window(t + (h - side) // 2, l + (w - side) // 2, side, side, height, width)
+        tiles = grid_windows(small, scale, t, l, h, w, max(min_size, int(math.ceil(
+            area * scale * scale / float(max(h, w)) * context))), height, width)
+        if len(tiles) > 1 and sum(th * tw for _, _, th, tw in tiles) < window[2] * window[3]:
+            windows.extend(tiles)
+        else:
+            windows.append(window)
+    # the bounding box of merged windows is grown back to a square, which
+    # may overlap other windows again, the windows cut by an image side
+    # are left alone so they do not slide over their neighbours
+    while True:
+        squares = []
+        for t, l, h, w in merge_windows(windows):
+            if (t, l, h, w) not in windows:
+                side = max(h, w)
+                t, l, h, w = clamp_window(t + (h - side) // 2, l + (w - side) // 2, side, side, height, width)
+            squares.append((t, l, h, w))
+        if squares == windows:
+            return windows
+        windows = squares
+
+
+def grid_windows(small, scale, t, l, h, w, side, height, width):
+    """Edge to edge square windows centred on a bounding box, keeping the ones with hole pixels.
+
+    The grid is shifted inside the image as a whole and the windows past
+    an image side are cut, so the windows never overlap each other.
+    """
+    rows, cols = int(math.ceil(h / float(side))), int(math.ceil(w / float(side)))
+    t = min(max(0, t + (h - rows * side) // 2), max(0, height - rows * side))
+    l = min(max(0, l + (w - cols * side) // 2), max(0, width - cols * side))
+    windows = []
+    for i in range(rows):
+        for j in range(cols):
+            ti, lj = t + i * side, l + j * side
+            hi, wj = min(side, height - ti), min(side, width - lj)
+            if hi <= 0 or wj <= 0:
+                continue
+            cell = small[0, 0, ti // scale:(ti + hi + scale - 1) // scale, lj // scale:(lj + wj + scale - 1) // scale]
+            if cell.any():
+                windows.append((ti, lj, hi, wj))
+    return windows
+
+
+def clamp_window(t, l, h, w, height, width):
+    """Shift (and if needed shrink) a window so that it lies inside the image."""
+    h, w = min(h, height), min(w, width)
+    t = min(max(0, t), height - h)
+    l = min(max(0, l), width - w)
+    return t, l, h, w
+
+
+def merge_windows(windows):
+    """Replace overlapping windows by their bounding box until none overlap."""
+    windows = list(windows)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                t1, l1, h1, w1 = windows[i]
+                t2, l2, h2, w2 = windows[j]
+                if t1 < t2 + h2 and t2 < t1 + h1 and l1 < l2 + w2 and l2 < l1 + w1:
+                    t, l = min(t1, t2), min(l1, l2)
+                    windows[i] = (t, l, max(t1 + h1, t2 + h2) - t, max(l1 + w1, l2 + w2) - l)
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return windows
+
+
+def resize_mask(mask, size):
+    """Resize [N, 1, H, W] masks so that every output pixel touching a hole is a hole."""
+    return F.adaptive_max_pool2d(mask, size)
+
+
+def feather_mask(mask, feather):
+    """1 inside the hole, ramping down to 0 over `feather` pixels outside of it."""
+    if feather <= 0:
+        return mask
+    k = 2 * feather + 1
+    soft = F.max_pool2d(mask.unsqueeze(dim=0), k, stride=1, padding=feather)
+    soft = F.avg_pool2d(soft, k, stride=1, padding=feather, count_include_pad=False)
+    return torch.max(soft[0], mask)
+
+
+def paste_windows(x, mask, windows, results, feather):
+    """Blend inpainted windows, K [3, h, w] tensors at any size, back into x."""
+    out = x.clone()
+    for (t, l, h, w), result in zip(windows, results):
+        result = F.interpolate(result.unsqueeze(dim=0), size=(h, w), mode='bilinear', align_corners=False)[0]
+        alpha = feather_mask(mask[:, t:t + h, l:l + w].to(x), feather)
+        out[:, t:t + h, l:l + w] = alpha * result + (1. - alpha) * out[:, t:t + h, l:l + w]
+    return out
+
+
+def test_roi_windows(min_size=256):
+    # a thin scratch across a 1024x2000 frame, the last window is cut by the image side
+    mask = torch.zeros(1, 1024, 2000)
+    mask[:, 500:508, :] = 1.
+    windows = roi_windows(mask, 2., min_size)
+    covered = torch.zeros_like(mask)
+    for t, l, h, w in windows:
+        assert max(h, w) <= min_size, 'A window of the scratch is larger than the training size'
+        assert covered[:, t:t + h, l:l + w].sum() == 0, 'The windows overlap'
+        covered[:, t:t + h, l:l + w] = 1.
+    assert (covered >= mask).all(), 'The windows do not cover the scratch'
+    assert covered.sum() <= mask.numel() / 4, 'The scratch windows cover most of the frame'
+
+    # a compact hole keeps a single window of context times its size
+    mask = torch.zeros(1, 1024, 2048)
+    mask[:, 300:450, 600:700] = 1.
+    assert roi_windows(mask, 2., min_size) == [(225, 500, 300, 300)], 'A compact hole is split'
+    return windows
@@ -1,31 +1,154 @@
+import copy
+import inspect
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils import spectral_norm as spectral_norm_fn
 from torch.nn.utils import weight_norm as weight_norm_fn
+from torch.utils.checkpoint import checkpoint
 from PIL import Image
 from torchvision import transforms
 from torchvision import utils as vutils
 
-from utils.tools import extract_image_patches, flow_to_image, \
+from utils.tools import extract_image_patches, pt_flow_to_image, \
     reduce_mean, reduce_sum, default_loader, same_padding
 
 
 class Generator(nn.Module):
-    def __init__(self, config, use_cuda):
+    def __init__(self, config, use_cuda, device_ids=None):
         super(Generator, self).__init__()
         self.input_dim = config['input_dim']
         self.cnum = config['ngf']
         self.use_cuda = use_cuda
 
         self.coarse_generator = CoarseGenerator(self.input_dim, self.cnum, self.use_cuda)
-        self.fine_generator = FineGenerator(self.input_dim, self.cnum, self.use_cuda)
+        self.fine_generator = FineGenerator(self.input_dim, self.cnum, self.use_cuda, config.get('attention'))
+        self.set_branch_mode(config.get('concat_first', False), config.get('concurrent_branches', False))
+        self.set_checkpointing(config.get('checkpoint', []))
+        # both stages downsample twice and the attention matches at 1/rate of that
+        self.size_multiple = 4 * self.fine_generator.contextul_attention.rate
+
+    def forward(self, x, mask, return_flow=None, skip_fine=None):
+        """Inpaint x in the hole given by mask.
+
+        Args:
+            mask: [N, 1, H, W], 1 in the hole, or [1, 1, H, W] shared by the
+                mini-batch.
+            skip_fine: Inference only. True returns the coarse output as the
+                second stage too, a function (x, x_stage1, mask) -> [N] bool
+                tensor skips the fine stage for the selected samples.
+        Returns:
+            tuple: (coarse output, fine output, offset flow or None)
+        """
+        # a single mask is shared by the whole mini-batch
+        if mask.size(0) != x.size(0):
+            mask = mask.expand(x.size(0), -1, -1, -1)
+        # inputs of any size are padded to a multiple of size_multiple and cropped back
+        height, width = x.size(2), x.size(3)
+        pad_h = -height % self.size_multiple
+        pad_w = -width % self.size_multiple
+        if pad_h or pad_w:
+            x, mask = self.pad_inputs(x, mask, pad_h, pad_w)
 
-    def forward(self, x, mask):
         x_stage1 = self.coarse_generator(x, mask)
-        x_stage2, offset_flow = self.fine_generator(x, x_stage1, mask)
+        if skip_fine is None or skip_fine is False:
+            x_stage2, offset_flow = self.fine_generator(x, x_stage1, mask, return_flow)
+        else:
+            x_stage2, offset_flow = self.refine(x, x_stage1, mask, return_flow, skip_fine)
+
+        if pad_h or pad_w:
+            top, left = pad_h // 2, pad_w // 2
+            x_stage1 = x_stage1[:, :, top:top + height, left:left + width]
+            x_stage2 = x_stage2[:, :, top:top + height, left:left + width]
+            if offset_flow is not None:
+                offset_flow = offset_flow[:, :, top:top + height, left:left + width]
         return x_stage1, x_stage2, offset_flow
 
+    def refine(self, x, x_stage1, mask, return_flow, skip_fine):
+        """Run the fine stage on the samples that skip_fine does not select."""
+        if skip_fine is True:
+            return x_stage1, None
+        idx = torch.nonzero(~skip_fine(x, x_stage1, mask)).view(-1)
+        if idx.numel() == x.size(0):
+            return self.fine_generator(x, x_stage1, mask, return_flow)
+        x_stage2 = x_stage1
+        offset_flow = None
+        if idx.numel() > 0:
+            x2, flow = self.fine_generator(x[idx], x_stage1[idx], mask[idx], return_flow)
+            x_stage2 = x_stage1.index_copy(0, idx, x2)
+            if flow is not None:
+                # the skipped samples have no attention, their flow stays black
+                offset_flow = flow.new_zeros([x.size(0)] + list(flow.size()[1:])).index_copy(0, idx, flow)
+        return x_stage2, offset_flow
+
+    def pad_inputs(self, x, mask, pad_h, pad_w):
+        """Mirror the image and the mask by pad_h/pad_w pixels, split over both edges.
+
+        Holes touching an edge are mirrored too, so the padding never
+        introduces known pixels that are not in the image.
+        """
+        top, left = pad_h // 2, pad_w // 2
+        padding = [left, pad_w - left, top, pad_h - top]
+        # reflection needs the padding to be smaller than the image
+        if max(padding) < min(x.size(2), x.size(3)):
+            mode = 'reflect'
+        else:
+            mode = 'replicate'
+        x = F.pad(x, padding, mode=mode)
+        mask = F.pad(mask.to(x), padding, mode=mode)
+        return x, mask
+
+    def set_branch_mode(self, concat_first=True, concurrent=True):
+        """Choose how FineGenerator runs its conv and attention branches.
+
+        concat_first runs the first conv of both branches, which see the
+        same input, as one wide conv. concurrent runs the conv branch on a
+        side CUDA stream (a worker thread on the CPU) while the attention
+        branch runs. Neither changes the parameters, so checkpoints load
+        in any mode.
+        """
+        self.fine_generator.concat_first = concat_first
+        self.fine_generator.concurrent_branches = concurrent
+        return self
+
+    def set_checkpointing(self, segments):
+        """Recompute the activations of some segments in backward instead of keeping them.
+
+        Args:
+            segments: List of 'coarse_atrous', 'fine_atrous' (the 64x64
+                dilated conv stacks) and 'attention' (ContextualAttention
+                and its score volume). Trades compute for training memory.
+        """
+        for segment in segments:
+            assert segment in ['coarse_atrous', 'fine_atrous', 'attention'], \
+                "Unsupported checkpoint segment: {}".format(segment)
+        self.coarse_generator.checkpoint_atrous = 'coarse_atrous' in segments
+        self.fine_generator.checkpoint_atrous = 'fine_atrous' in segments
+        self.fine_generator.checkpoint_attention = 'attention' in segments
+        return self
+
+    def fuse_for_inference(self, channels_last=False):
+        """Prepare the generator for inference only.
+
+        Every Conv2dBlock folds its zero padding into the padding of its
+        conv, which gives the same output up to the conv backend (checked
+        to 1e-6 by test_fuse_for_inference). channels_last also switches the
+        weights to that memory format. It is often faster, but it changes
+        the conv accumulation order, so the output differs by fp32 rounding
+        (a few 1e-8, checked to 1e-5).
+        """
+        for module in self.modules():
+            if isinstance(module, Conv2dBlock):
+                module.fuse_for_inference()
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        return self.eval()
+
 
 class CoarseGenerator(nn.Module):
     def __init__(self, input_dim, cnum, use_cuda=True):
@@ -52,13 +175,13 @@ class CoarseGenerator(nn.Module):
         self.conv15 = gen_conv(cnum*2, cnum, 3, 1, 1)
         self.conv16 = gen_conv(cnum, cnum//2, 3, 1, 1)
         self.conv17 = gen_conv(cnum//2, input_dim, 3, 1, 1, activation='none')
+        # see Generator.set_checkpointing
+        self.checkpoint_atrous = False
 
     def forward(self, x, mask):
         # For indicating the boundaries of images
-        ones = torch.ones(x.size(0), 1, x.size(2), x.size(3))
-        if self.use_cuda:
-            ones = ones.cuda()
-            mask = mask.cuda()
+        ones = x.new_ones(x.size(0), 1, x.size(2), x.size(3))
+        mask = mask.to(x)
         # 5 x 256 x 256
         x = self.conv1(torch.cat([x, ones, mask], dim=1))
         x = self.conv2_downsample(x)
@@ -68,10 +191,7 @@ class CoarseGenerator(nn.Module):
         # cnum*4 x 64 x 64
         x = self.conv5(x)
         x = self.conv6(x)
-        x = self.conv7_atrous(x)
-        x = self.conv8_atrous(x)
-        x = self.conv9_atrous(x)
-        x = self.conv10_atrous(x)
+        x = run_segment(self.atrous, x, recompute=self.checkpoint_atrous)
         x = self.conv11(x)
         x = self.conv12(x)
         x = F.interpolate(x, scale_factor=2, mode='nearest')
@@ -88,9 +208,16 @@ class CoarseGenerator(nn.Module):
 
         return x_stage1
 
+    def atrous(self, x):
+        x = self.conv7_atrous(x)
+        x = self.conv8_atrous(x)
+        x = self.conv9_atrous(x)
+        x = self.conv10_atrous(x)
+        return x
+
 
 class FineGenerator(nn.Module):
-    def __init__(self, input_dim, cnum, use_cuda=True):
+    def __init__(self, input_dim, cnum, use_cuda=True, attention=None):
         super(FineGenerator, self).__init__()
         self.use_cuda = use_cuda
 
@@ -119,8 +246,13 @@ class FineGenerator(nn.Module):
         # cnum*4 x 64 x 64
         self.pmconv5 = gen_conv(cnum*4, cnum*4, 3, 1, 1)
         self.pmconv6 = gen_conv(cnum*4, cnum*4, 3, 1, 1, activation='relu')
+        # masked_margin: the layers after the attention read the attention
+        # output up to 4 matching positions (32 pixels) away from a hole pixel
+        options = {'masked_margin': 4}
+        # engine, masked_only, chunk_size and memory_budget, see ContextualAttention
+        options.update(attention or {})
         self.contextul_attention = ContextualAttention(ksize=3, stride=1, rate=2, fuse_k=3, softmax_scale=10,
-                                                       fuse=True, use_cuda=self.use_cuda)
+                                                       fuse=True, use_cuda=self.use_cuda, **options)
         self.pmconv9 = gen_conv(cnum*4, cnum*4, 3, 1, 1)
         self.pmconv10 = gen_conv(cnum*4, cnum*4, 3, 1, 1)
         self.allconv11 = gen_conv(cnum*8, cnum*4, 3, 1, 1)
@@ -130,57 +262,148 @@ class FineGenerator(nn.Module):
         self.allconv15 = gen_conv(cnum*2, cnum, 3, 1, 1)
         self.allconv16 = gen_conv(cnum, cnum//2, 3, 1, 1)
         self.allconv17 = gen_conv(cnum//2, input_dim, 3, 1, 1, activation='none')
-
-    def forward(self, xin, x_stage1, mask):
+        # see Generator.set_branch_mode
+        self.concat_first = False
+        self.concurrent_branches = False
+        # see Generator.set_checkpointing
+        self.checkpoint_atrous = False
+        self.checkpoint_attention = False
+
+    def forward(self, xin, x_stage1, mask, return_flow=None):
+        mask = mask.to(xin)
         x1_inpaint = x_stage1 * mask + xin * (1. - mask)
         # For indicating the boundaries of images
-        ones = torch.ones(xin.size(0), 1, xin.size(2), xin.size(3))
-        if self.use_cuda:
-            ones = ones.cuda()
-            mask = mask.cuda()
-        # conv branch
+        ones = xin.new_ones(xin.size(0), 1, xin.size(2), xin.size(3))
         xnow = torch.cat([x1_inpaint, ones, mask], dim=1)
-        x = self.conv1(xnow)
+        # both branches start with the same conv shape on xnow
+        if self.concat_first:
+            x, x_pm = concat_conv_blocks([self.conv1, self.pmconv1], xnow)
+        else:
+            x = self.conv1(xnow)
+            x_pm = self.pmconv1(xnow)
+        if self.concurrent_branches:
+            x_hallu, (pm, offset_flow) = run_concurrently(lambda: self.conv_branch(x),
+                                                          lambda: self.attention_branch(x_pm, mask, return_flow),
+                                                          xnow.device)
+        else:
+            x_hallu = self.conv_branch(x)
+            pm, offset_flow = self.attention_branch(x_pm, mask, return_flow)
+        x = torch.cat([x_hallu, pm], dim=1)
+        # merge two branches
+        x = self.allconv11(x)
+        x = self.allconv12(x)
+        x = F.interpolate(x, scale_factor=2, mode='nearest')
+        x = self.allconv13(x)
+        x = self.allconv14(x)
+        x = F.interpolate(x, scale_factor=2, mode='nearest')
+        x = self.allconv15(x)
+        x = self.allconv16(x)
+        x = self.allconv17(x)
+        x_stage2 = torch.clamp(x, -1., 1.)
+
+        return x_stage2, offset_flow
+
+    def conv_branch(self, x):
+        """Hallucination branch, after conv1."""
         x = self.conv2_downsample(x)
         x = self.conv3(x)
         x = self.conv4_downsample(x)
         x = self.conv5(x)
         x = self.conv6(x)
+        x = run_segment(self.atrous, x, recompute=self.checkpoint_atrous)
+        return x
+
+    def atrous(self, x):
         x = self.conv7_atrous(x)
         x = self.conv8_atrous(x)
         x = self.conv9_atrous(x)
         x = self.conv10_atrous(x)
-        x_hallu = x
-        # attention branch
-        x = self.pmconv1(xnow)
+        return x
+
+    def attention_branch(self, x, mask, return_flow=None):
+        """Contextual attention branch, after pmconv1."""
         x = self.pmconv2_downsample(x)
         x = self.pmconv3(x)
         x = self.pmconv4_downsample(x)
         x = self.pmconv5(x)
         x = self.pmconv6(x)
-        x, offset_flow = self.contextul_attention(x, x, mask)
+        if self.checkpoint_attention:
+            # the flow does not need gradients, keep the one of the first run
+            flows = []
+
+            def attention(x, mask):
+                y, flow = self.contextul_attention(x, x, mask, return_flow)
+                flows.append(flow)
+                return y
+            x = run_segment(attention, x, mask, recompute=True)
+            offset_flow = flows[0]
+        else:
+            x, offset_flow = self.contextul_attention(x, x, mask, return_flow)
         x = self.pmconv9(x)
         x = self.pmconv10(x)
-        pm = x
-        x = torch.cat([x_hallu, pm], dim=1)
-        # merge two branches
-        x = self.allconv11(x)
-        x = self.allconv12(x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
-        x = self.allconv13(x)
-        x = self.allconv14(x)
-        x = F.interpolate(x, scale_factor=2, mode='nearest')
-        x = self.allconv15(x)
-        x = self.allconv16(x)
-        x = self.allconv17(x)
-        x_stage2 = torch.clamp(x, -1., 1.)
+        return x, offset_flow
+
+
+# the non-reentrant checkpoint (PyTorch 1.11+) also works with DistributedDataParallel
+_checkpoint_kwargs = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def run_segment(fn, *args, recompute=False):
+    """Return fn(*args), recomputing its activations in backward instead of keeping them if recompute."""
+    if recompute and torch.is_grad_enabled() and any(torch.is_tensor(a) and a.requires_grad for a in args):
+        return checkpoint(fn, *args, **_checkpoint_kwargs)
+    return fn(*args)
 
-        return x_stage2, offset_flow
+
+_side_streams = {}
+_branch_pool = None
+_branch_pool_lock = threading.Lock()
+
+
+def run_concurrently(side, main, device):
+    """Return (side(), main()), running side on a side CUDA stream or a worker thread."""
+    global _branch_pool
+    if device.type == 'cuda':
+        current = torch.cuda.current_stream(device)
+        if device not in _side_streams:
+            _side_streams[device] = torch.cuda.Stream(device=device)
+        stream = _side_streams[device]
+        stream.wait_stream(current)
+        with torch.cuda.stream(stream):
+            side_out = side()
+        main_out = main()
+        current.wait_stream(stream)
+        side_out.record_stream(current)
+        return side_out, main_out
+
+    with _branch_pool_lock:
+        if _branch_pool is None:
+            _branch_pool = ThreadPoolExecutor(max_workers=1)
+    # the autograd and autocast modes are thread local
+    grad_enabled = torch.is_grad_enabled()
+    autocast_dtype = None
+    if hasattr(torch, 'is_autocast_cpu_enabled') and torch.is_autocast_cpu_enabled():
+        autocast_dtype = torch.get_autocast_cpu_dtype()
+
+    def run_side():
+        autocast = nullcontext() if autocast_dtype is None else torch.autocast('cpu', dtype=autocast_dtype)
+        with torch.set_grad_enabled(grad_enabled), autocast:
+            return side()
+
+    future = _branch_pool.submit(run_side)
+    main_out = main()
+    return future.result(), main_out
+
+
+def _upcast_half(x):
+    """x in fp32 if it is fp16 or bf16, unchanged otherwise."""
+    return x.float() if x.dtype in (torch.float16, torch.bfloat16) else x
 
 
 class ContextualAttention(nn.Module):
     def __init__(self, ksize=3, stride=1, rate=1, fuse_k=3, softmax_scale=10,
-                 fuse=False, use_cuda=False):
+                 fuse=False, use_cuda=False, engine='conv', masked_only=False, masked_margin=1,
+                 chunk_size=None, memory_budget=None, return_flow=True):
         super(ContextualAttention, self).__init__()
         self.ksize = ksize
         self.stride = stride
@@ -189,8 +412,25 @@ class ContextualAttention(nn.Module):
         self.softmax_scale = softmax_scale
         self.fuse = fuse
         self.use_cuda = use_cuda
-
-    def forward(self, f, b, mask=None):
+        # not saved in the state dict, so that older checkpoints still load
+        self.register_buffer('fuse_weight', torch.eye(fuse_k).view(1, 1, fuse_k, fuse_k), persistent=False)
+        # 'conv': the whole mini-batch is matched at once with grouped convolutions
+        # 'gemm': patches are unfolded once and matched with batched matmuls
+        # 'loop': the reference implementation, one sample at a time
+        assert engine in ['conv', 'gemm', 'loop'], "Unsupported attention engine: {}".format(engine)
+        self.engine = engine
+        # only match the foreground inside the mask grown by masked_margin
+        # positions, the rest pastes its own patch of b, see _attend_gathered
+        self.masked_only = masked_only
+        self.masked_margin = masked_margin
+        # tiled mode: match chunk_size foreground positions at a time and keep
+        # each score tile under memory_budget MB
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        # default for forward(): visualize the offsets as an optical flow image
+        self.return_flow = return_flow
+
+    def forward(self, f, b, mask=None, return_flow=None):
         """ Contextual attention layer implementation.
         Contextual attention is first introduced in publication:
             Generative Image Inpainting with Contextual Attention, Yu et al.
@@ -202,11 +442,15 @@ class ContextualAttention(nn.Module):
             stride: Stride for extracting patches from b.
             rate: Dilation for matching.
             softmax_scale: Scaled softmax for attention.
+            return_flow: Whether to compute the offset flow image, defaults
+                to self.return_flow. The flow needs a device to host copy.
         Returns:
-            torch.tensor: output
+            tuple: (output, flow image or None)
         """
+        # the patch matching reshapes NCHW tensors
+        f = f.contiguous()
+        b = b.contiguous()
         # get shapes
-        raw_int_fs = list(f.size())   # b*c*h*w
         raw_int_bs = list(b.size())   # b*c*h*w
 
         # extract patches from background with stride and rate
@@ -220,7 +464,6 @@ class ContextualAttention(nn.Module):
         # raw_shape: [N, C, k, k, L]
         raw_w = raw_w.view(raw_int_bs[0], raw_int_bs[1], kernel, kernel, -1)
         raw_w = raw_w.permute(0, 4, 1, 2, 3)    # raw_shape: [N, L, C, k, k]
-        raw_w_groups = torch.split(raw_w, 1, dim=0)
 
         # downscaling foreground option: downscaling both foreground and
         # background for matching and use original background for reconstruction.
@@ -228,7 +471,6 @@ class ContextualAttention(nn.Module):
         b = F.interpolate(b, scale_factor=1./self.rate, mode='nearest')
         int_fs = list(f.size())     # b*c*h*w
         int_bs = list(b.size())
-        f_groups = torch.split(f, 1, dim=0)  # split tensors along the batch dimension
         # w shape: [N, C*k*k, L]
         w = extract_image_patches(b, ksizes=[self.ksize, self.ksize],
                                   strides=[self.stride, self.stride],
@@ -237,14 +479,13 @@ class ContextualAttention(nn.Module):
         # w shape: [N, C, k, k, L]
         w = w.view(int_bs[0], int_bs[1], self.ksize, self.ksize, -1)
         w = w.permute(0, 4, 1, 2, 3)    # w shape: [N, L, C, k, k]
-        w_groups = torch.split(w, 1, dim=0)
 
         # process mask
+        holes = None
         if mask is None:
-            mask = torch.zeros([int_bs[0], 1, int_bs[2], int_bs[3]])
-            if self.use_cuda:
-                mask = mask.cuda()
+            mask = b.new_zeros([int_bs[0], 1, int_bs[2], int_bs[3]])
         else:
+            holes = mask
             mask = F.interpolate(mask, scale_factor=1./(4*self.rate), mode='nearest')
         int_ms = list(mask.size())
         # m shape: [N, C*k*k, L]
@@ -255,20 +496,383 @@ class ContextualAttention(nn.Module):
         # m shape: [N, C, k, k, L]
         m = m.view(int_ms[0], int_ms[1], self.ksize, self.ksize, -1)
         m = m.permute(0, 4, 1, 2, 3)    # m shape: [N, L, C, k, k]
-        m = m[0]    # m shape: [L, C, k, k]
-        # mm shape: [L, 1, 1, 1]
-        mm = (reduce_mean(m, axis=[1, 2, 3], keepdim=True)==0.).to(torch.float32)
-        mm = mm.permute(1, 0, 2, 3) # mm shape: [1, L, 1, 1]
+        # every sample keeps its own mask, so that images with different
+        # holes can share a mini-batch
+        mm = (reduce_mean(m, axis=[2, 3, 4])==0.).to(f.dtype)
+        mm = mm.view(int_ms[0], -1, 1, 1) # mm shape: [N, L, 1, 1]
+        if int_ms[0] != int_bs[0]:
+            # a single mask is shared by the whole mini-batch
+            mm = mm.expand(int_bs[0], -1, -1, -1)
+
+        if self.masked_only and holes is not None:
+            y, offsets = self._attend_gathered(f, w, raw_w, mm, holes, int_fs, int_bs)
+        elif self.chunk_size or self.memory_budget:
+            y, offsets = self._attend_gathered(f, w, raw_w, mm, None, int_fs, int_bs)
+        elif self.engine == 'loop':
+            y, offsets = self._attend_loop(f, w, raw_w, mm, int_fs, int_bs)
+        elif self.engine == 'gemm':
+            y, offsets = self._attend_gemm(f, w, raw_w, mm, int_fs, int_bs)
+        else:
+            y, offsets = self._attend_conv(f, w, raw_w, mm, int_fs, int_bs)
+
+        if return_flow is None:
+            return_flow = self.return_flow
+        if not return_flow:
+            return y, None
+
+        if int_bs != int_fs:
+            # Normalize the offset value to match foreground dimension
+            times = float(int_fs[2] * int_fs[3]) / float(int_bs[2] * int_bs[3])
+            offsets = ((offsets + 1).float() * times - 1).to(torch.int64)
+        offsets = torch.cat([offsets//int_fs[3], offsets%int_fs[3]], dim=1)  # N*2*H*W
+
+        # case1: visualize optical flow: minus current position
+        h_add = torch.arange(int_fs[2], device=offsets.device).view([1, 1, int_fs[2], 1]).expand(int_fs[0], -1, -1, int_fs[3])
+        w_add = torch.arange(int_fs[3], device=offsets.device).view([1, 1, 1, int_fs[3]]).expand(int_fs[0], -1, int_fs[2], -1)
+        ref_coordinate = torch.cat([h_add, w_add], dim=1)
+
+        offsets = offsets - ref_coordinate
+        flow = pt_flow_to_image(offsets) / 255.
+        # case2: visualize which pixels are attended
+        # flow = pt_highlight_flow(offsets * mask.long()) / 255.
+
+        if self.rate != 1:
+            flow = F.interpolate(flow, scale_factor=self.rate*4, mode='nearest')
+
+        return y, flow
+
+    def _normalize(self, w, axis):
+        """Divide the patches by their L2 norm over axis, at least 1e-4 to escape NaN.
+
+        Half precision patches are normalized in fp32, the squares overflow in fp16.
+        """
+        w32 = _upcast_half(w)
+        w_norm = torch.sqrt(reduce_sum(torch.pow(w32, 2), axis=axis, keepdim=True))
+        return (w32 / torch.clamp(w_norm, min=1e-4)).to(w.dtype)
+
+    def _masked_softmax(self, y, mm):
+        """softmax(y * mm) * mm over the background positions (dim 1), in fp32 for half precision scores."""
+        dtype = y.dtype
+        y = _upcast_half(y)
+        mm = mm.to(y.dtype)
+        y = y * mm
+        y = F.softmax(y*self.softmax_scale, dim=1)
+        return (y * mm).to(dtype)
+
+    def _attend_conv(self, f, w, raw_w, mm, int_fs, int_bs):
+        """Match and reconstruct the whole mini-batch at once.
+
+        The samples are stacked along the channel dimension so that every
+        conv of the per-sample loop becomes a single grouped conv.
+        Args:
+            f: Downscaled foreground, [N, C, Hf, Wf].
+            w: Background patches for matching, [N, L, C, k, k].
+            raw_w: Background patches for reconstruction, [N, L, C, 2*rate, 2*rate].
+            mm: Available background patches of every sample, [N, L, 1, 1].
+        Returns:
+            tuple: (output [N, C, H, W], argmax offsets [N, 1, Hf, Wf])
+        """
+        n, c = int_fs[0], int_fs[1]
+        l = int_bs[2] * int_bs[3]
+        k = self.fuse_k
+        w_normed = self._normalize(w, axis=[2, 3, 4])
+        # f: 1*(N*C)*H*W, filters: (N*L)*C*k*k, y: N*L*H*W
+        x = same_padding(f, [self.ksize, self.ksize], [1, 1], [1, 1])
+        x = x.view(1, n * c, x.size(2), x.size(3))
+        y = F.conv2d(x, w_normed.reshape(n * l, c, self.ksize, self.ksize), stride=1, groups=n)
+        # conv implementation for fuse scores to encourage large patches
+        if self.fuse:
+            fuse_weight = self.fuse_weight.to(y.dtype)  # 1*1*k*k
+            # every sample is an independent 1*(Hb*Wb)*(Hf*Wf) image
+            y = y.view(n, 1, l, int_fs[2]*int_fs[3])
+            y = same_padding(y, [k, k], [1, 1], [1, 1])
+            y = F.conv2d(y, fuse_weight, stride=1)
+            y = y.contiguous().view(n, int_bs[2], int_bs[3], int_fs[2], int_fs[3])
+            y = y.permute(0, 2, 1, 4, 3)
+            y = y.contiguous().view(n, 1, l, int_fs[2]*int_fs[3])
+            y = same_padding(y, [k, k], [1, 1], [1, 1])
+            y = F.conv2d(y, fuse_weight, stride=1)
+            y = y.contiguous().view(n, int_bs[3], int_bs[2], int_fs[3], int_fs[2])
+            y = y.permute(0, 2, 1, 4, 3).contiguous()
+        y = y.view(n, l, int_fs[2], int_fs[3])
+        # softmax to match
+        y = self._masked_softmax(y, mm)  # [N, L, H, W]
+
+        offsets = torch.argmax(y, dim=1, keepdim=True)  # N*1*H*W
+
+        # deconv for patch pasting, again grouped over the samples
+        raw_w = raw_w.reshape(n * l, c, raw_w.size(3), raw_w.size(4))
+        y = y.view(1, n * l, int_fs[2], int_fs[3])
+        y = F.conv_transpose2d(y, raw_w, stride=self.rate, padding=1, groups=n) / 4.
+        y = y.view(n, c, y.size(2), y.size(3))
+
+        return y, offsets
+
+    def _attend_gemm(self, f, w, raw_w, mm, int_fs, int_bs):
+        """Match and reconstruct the mini-batch with batched matrix multiplies.
+
+        Foreground and background are unfolded once and the cosine
+        similarities of all foreground/background patch pairs are a single
+        bmm. The fuse convs are diagonal, so they become shifted adds on the
+        score matrix, and the deconv becomes a bmm followed by a fold.
+        Args and returns are the same as for `_attend_conv`.
+        """
+        n = int_fs[0]
+        l = int_bs[2] * int_bs[3]
+        p = int_fs[2] * int_fs[3]
+        w = w.reshape(n, l, -1)  # [N, L, C*k*k]
+        w_normed = self._normalize(w, axis=[2])
+        x = extract_image_patches(f, ksizes=[self.ksize, self.ksize],
+                                  strides=[1, 1],
+                                  rates=[1, 1],
+                                  padding='same')  # [N, C*k*k, P]
+        y = torch.bmm(w_normed, x)  # [N, L, P]
+        if self.fuse:
+            y = self._fuse_scores(y)
+            y = y.view(n, int_bs[2], int_bs[3], int_fs[2], int_fs[3])
+            y = y.permute(0, 2, 1, 4, 3).reshape(n, l, p)
+            y = self._fuse_scores(y)
+            y = y.view(n, int_bs[3], int_bs[2], int_fs[3], int_fs[2])
+            y = y.permute(0, 2, 1, 4, 3).reshape(n, l, p)
+        # softmax to match
+        y = self._masked_softmax(y, mm.view(n, l, 1))  # [N, L, P]
+
+        offsets = torch.argmax(y, dim=1).view(n, 1, int_fs[2], int_fs[3])  # N*1*H*W
+
+        # paste the background patches weighted by the attention scores
+        kernel = raw_w.size(3)
+        raw_w = raw_w.reshape(n, l, -1).transpose(1, 2)  # [N, C*k*k, L]
+        y = torch.bmm(raw_w, y)  # [N, C*k*k, P]
+        out_size = [(s - 1) * self.rate - 2 + kernel for s in int_fs[2:]]
+        y = F.fold(y, out_size, kernel_size=kernel, stride=self.rate, padding=1) / 4.
+
+        return y, offsets
+
+    def _attend_gathered(self, f, w, raw_w, mm, holes, int_fs, int_bs):
+        """Match a gathered set of foreground positions, for the masked-only and tiled modes.
+
+        In masked-only mode only the hole (the union over the mini-batch)
+        grown by masked_margin positions is matched, the score volume
+        shrinks with the hole area. The other positions paste their own
+        patch of b instead of attending to the whole background, so the
+        output is only exact up to masked_margin - 1 positions around the
+        hole: the margin has to cover the receptive field of the layers
+        that read the output (one position for the pasted patches alone).
+        Args:
+            holes: Mask at the input resolution, [N, 1, H, W], or None to
+                match every foreground position.
+        Other args and returns are the same as for `_attend_conv`.
+        """
+        n = int_fs[0]
+        l = int_bs[2] * int_bs[3]
+        p = int_fs[2] * int_fs[3]
+        kernel = raw_w.size(3)
+        raw_w = raw_w.reshape(n, l, -1).transpose(1, 2)  # [N, C*k*k, L]
+        w = w.reshape(n, l, -1)  # [N, L, C*k*k]
+        w_normed = self._normalize(w, axis=[2])
+        x = extract_image_patches(f, ksizes=[self.ksize, self.ksize],
+                                  strides=[1, 1],
+                                  rates=[1, 1],
+                                  padding='same')  # [N, C*k*k, P]
+        mm = mm.view(n, l)
+
+        if holes is None:
+            cols = torch.arange(p, device=x.device)
+            y, offsets = self._match_columns(w_normed, x, raw_w, mm, cols, int_fs, int_bs)
+        else:
+            # far from the hole every position pastes its own patch
+            assert int_bs[2:] == int_fs[2:], "masked_only needs f and b of the same size"
+            y = raw_w
+            offsets = torch.arange(p, device=y.device).view(1, p).repeat(n, 1)
+
+            # a position is in the hole if any of its pixels is
+            holes = F.adaptive_max_pool2d(holes.float(), int_fs[2:])
+            margin = self.masked_margin
+            holes = F.max_pool2d(holes, 2 * margin + 1, stride=1, padding=margin)
+            cols = torch.nonzero(holes.sum(0).view(-1) > 0).view(-1)
+            if cols.numel() > 0:
+                yi, offsets_i = self._match_columns(w_normed, x, raw_w, mm, cols, int_fs, int_bs)
+                offsets = offsets.index_copy(1, cols, offsets_i)
+                y = y.index_copy(2, cols, yi)
+
+        offsets = offsets.reshape(n, 1, int_fs[2], int_fs[3])  # N*1*H*W
+        out_size = [(s - 1) * self.rate - 2 + kernel for s in int_fs[2:]]
+        y = F.fold(y, out_size, kernel_size=kernel, stride=self.rate, padding=1) / 4.
+
+        return y, offsets
+
+    def _match_columns(self, w_normed, x, raw_w, mm, cols, int_fs, int_bs):
+        """Attend the foreground positions in cols to the whole background.
+
+        Without a chunk size or memory budget the scores of all the columns
+        are computed at once. Otherwise the columns are processed in chunks
+        and the background in tiles, with a streaming softmax that rescales
+        the running sums whenever the running maximum grows, so only one
+        score tile is alive at a time.
+        Args:
+            w_normed: Normalized background patches, [N, L, C*k*k].
+            x: Foreground patches, [N, C*k*k, P].
+            raw_w: Background patches for reconstruction, [N, C*kr*kr, L].
+            mm: Available background patches, [N, L].
+            cols: Foreground positions to match, LongTensor of size Q.
+        Returns:
+            tuple: (pasted patches [N, C*kr*kr, Q], argmax offsets [N, Q])
+        """
+        n, l = w_normed.size(0), w_normed.size(1)
+
+        def scores(r, c):
+            return torch.bmm(w_normed[:, r], x[:, :, c])
+
+        if not (self.chunk_size or self.memory_budget):
+            rows = torch.arange(l, device=cols.device)
+            yi = self._fused_scores_at(scores, rows, cols, int_fs, int_bs)  # [N, L, Q]
+            # softmax to match
+            yi = self._masked_softmax(yi, mm.view(n, l, 1))  # [N, L, Q]
+            return torch.bmm(raw_w, yi), torch.argmax(yi, dim=1)
+
+        col_chunk, row_chunk = self._chunk_sizes(n, l, cols.numel(), w_normed.element_size(),
+                                                 int_fs, int_bs)
+        y = []
+        offsets = []
+        for cols_i in torch.split(cols, col_chunk):
+            q = cols_i.numel()
+            # the streaming softmax is accumulated in fp32 whatever the input precision
+            running_max = x.new_full((n, q), float('-inf'), dtype=torch.float32)
+            denom = x.new_zeros(n, q, dtype=torch.float32)
+            acc = x.new_zeros(n, raw_w.size(1), q, dtype=torch.float32)
+            best = x.new_full((n, q), float('-inf'), dtype=torch.float32)
+            offset = torch.zeros(n, q, dtype=torch.int64, device=x.device)
+            for start in range(0, l, row_chunk):
+                stop = min(l, start + row_chunk)
+                rows = torch.arange(start, stop, device=x.device)
+                mm_i = mm[:, start:stop].unsqueeze(2).float()
+                # unavailable patches score 0 and stay in the normalization, as in softmax(yi * mm)
+                yi = self._fused_scores_at(scores, rows, cols_i, int_fs, int_bs).float() * mm_i
+                yi = yi * self.softmax_scale
+                new_max = torch.max(running_max, torch.max(yi, dim=1)[0])
+                alpha = torch.exp(running_max - new_max)
+                e = torch.exp(yi - new_max.unsqueeze(1))
+                denom = denom * alpha + e.sum(dim=1)
+                acc = acc * alpha.unsqueeze(1) + torch.bmm(raw_w[:, :, start:stop].float(), e * mm_i)
+                running_max = new_max
+                # the argmax of softmax * mm is the best available patch
+                tile_best, tile_offset = torch.max(yi.masked_fill(mm_i == 0, float('-inf')), dim=1)
+                better = tile_best > best
+                best = torch.where(better, tile_best, best)
+                offset = torch.where(better, tile_offset + start, offset)
+            y.append((acc / denom.unsqueeze(1)).to(raw_w.dtype))
+            offsets.append(offset)
+
+        return torch.cat(y, dim=2), torch.cat(offsets, dim=1)
+
+    def _chunk_sizes(self, n, l, q, element_size, int_fs, int_bs):
+        """Foreground and background positions per score tile.
+
+        Returns:
+            tuple: (foreground chunk, background chunk)
+        """
+        if self.memory_budget:
+            # a tile and its fuse halo are copied a few times by the fuse
+            elems = max(1, int(self.memory_budget * 2**20 / (4 * element_size * n)))
+            col_chunk = self.chunk_size or int(math.sqrt(elems))
+            row_chunk = elems // (col_chunk + 2 * int_fs[3] + 2) - 2 * int_bs[3] - 2
+        else:
+            col_chunk = self.chunk_size
+            row_chunk = l
+        return max(1, min(q, col_chunk)), max(1, min(l, row_chunk))
+
+    def _fused_scores_at(self, scores, rows, cols, int_fs, int_bs):
+        """Fused matching scores for a subset of background/foreground positions.
+
+        Only the positions the two fuse passes read from are scored.
+        Args:
+            scores: Function mapping (rows, cols) position tensors to the raw
+                scores of those background/foreground pairs, [N, R, Q].
+            rows: Background positions, LongTensor of size R.
+            cols: Foreground positions, LongTensor of size Q.
+        Returns:
+            torch.tensor: fused scores, [N, R, Q]
+        """
+        if not self.fuse:
+            return scores(rows, cols)
+        # the second (transposed) pass reads the first pass at these positions ...
+        rows_t, rows_t_valid = self._fuse_neighbors(rows, int_bs[2], int_bs[3], True)
+        cols_t, cols_t_valid = self._fuse_neighbors(cols, int_fs[2], int_fs[3], True)
+        rows1, rows_t = torch.unique(rows_t, return_inverse=True)
+        cols1, cols_t = torch.unique(cols_t, return_inverse=True)
+        # ... which reads the raw scores at these positions
+        rows_r, rows_r_valid = self._fuse_neighbors(rows1, int_bs[2], int_bs[3], False)
+        cols_r, cols_r_valid = self._fuse_neighbors(cols1, int_fs[2], int_fs[3], False)
+        rows0, rows_r = torch.unique(rows_r, return_inverse=True)
+        cols0, cols_r = torch.unique(cols_r, return_inverse=True)
+
+        y = scores(rows0, cols0)
+        y = self._sum_diagonals(y, rows_r, rows_r_valid, cols_r, cols_r_valid)
+        y = self._sum_diagonals(y, rows_t, rows_t_valid, cols_t, cols_t_valid)
+        return y
+
+    def _fuse_neighbors(self, idx, h, w, transposed):
+        """Flat positions read by the identity fuse kernel at the positions in idx.
+
+        The fuse convs see the scores as an image whose rows (columns) are the
+        background (foreground) positions flattened in row-major order, or in
+        column-major order for the transposed pass, so the neighbours wrap
+        around the feature map rows exactly like in `_fuse_scores`.
+        Returns:
+            tuple: (neighbours [k, len(idx)], in range [k, len(idx)])
+        """
+        k = self.fuse_k
+        top = (k - 1) // 2
+        if transposed:
+            idx = (idx % w) * h + idx // w
+        shifts = torch.arange(-top, k - top, device=idx.device).view(-1, 1)
+        nb = idx.view(1, -1) + shifts
+        valid = (nb >= 0) & (nb < h * w)
+        nb = torch.clamp(nb, 0, h * w - 1)
+        if transposed:
+            nb = (nb % h) * w + nb // h
+        return nb, valid
+
+    def _sum_diagonals(self, y, rows, rows_valid, cols, cols_valid):
+        """Sum y over the (row, column) neighbours of every fuse offset."""
+        fused = 0.
+        for i in range(rows.size(0)):
+            valid = rows_valid[i].view(-1, 1) & cols_valid[i].view(1, -1)
+            fused = fused + y[:, rows[i]][:, :, cols[i]] * valid.to(y.dtype)
+        return fused
+
+    def _fuse_scores(self, y):
+        """Convolve the score matrix of every sample with an identity kernel.
+
+        Equivalent to the `fuse_weight` conv of `_attend_conv` with 'same'
+        padding: the output is the sum of the k diagonally shifted copies.
+        Args:
+            y: Scores, [N, L, P].
+        Returns:
+            torch.tensor: fused scores, [N, L, P]
+        """
+        k = self.fuse_k
+        top = (k - 1) // 2
+        l, p = y.size(1), y.size(2)
+        y_pad = F.pad(y, [top, k - 1 - top, top, k - 1 - top])
+        fused = y_pad[:, :l, :p]
+        for i in range(1, k):
+            fused = fused + y_pad[:, i:i + l, i:i + p]
+        return fused
+
+    def _attend_loop(self, f, w, raw_w, mm, int_fs, int_bs):
+        """Reference implementation of `_attend_conv`, one sample at a time."""
+        raw_w_groups = torch.split(raw_w, 1, dim=0)
+        f_groups = torch.split(f, 1, dim=0)  # split tensors along the batch dimension
+        w_groups = torch.split(w, 1, dim=0)
+        mm_groups = torch.split(mm, 1, dim=0)
 
         y = []
         offsets = []
         k = self.fuse_k
-        scale = self.softmax_scale    # to fit the PyTorch tensor image value range
-        fuse_weight = torch.eye(k).view(1, 1, k, k)  # 1*1*k*k
-        if self.use_cuda:
-            fuse_weight = fuse_weight.cuda()
+        fuse_weight = self.fuse_weight.to(f.dtype)  # 1*1*k*k
 
-        for xi, wi, raw_wi in zip(f_groups, w_groups, raw_w_groups):
+        for xi, wi, raw_wi, mmi in zip(f_groups, w_groups, raw_w_groups, mm_groups):
             '''
             O => output channel as a conv filter
             I => input channel as a conv filter
@@ -277,15 +881,8 @@ class ContextualAttention(nn.Module):
             raw_wi : separated tensor along batch dimension of back; (B=1, I=32*32, O=128, KH=4, KW=4)
             '''
             # conv for compare
-            escape_NaN = torch.FloatTensor([1e-4])
-            if self.use_cuda:
-                escape_NaN = escape_NaN.cuda()
             wi = wi[0]  # [L, C, k, k]
-            max_wi = torch.max(torch.sqrt(reduce_sum(torch.pow(wi, 2),
-                                                     axis=[1, 2, 3],
-                                                     keepdim=True)),
-                               escape_NaN)
-            wi_normed = wi / max_wi
+            wi_normed = self._normalize(wi, axis=[1, 2, 3])
             # xi shape: [1, C, H, W], yi shape: [1, L, H, W]
             xi = same_padding(xi, [self.ksize, self.ksize], [1, 1], [1, 1])  # xi: 1*c*H*W
             yi = F.conv2d(xi, wi_normed, stride=1)   # [1, L, H, W]
@@ -304,18 +901,10 @@ class ContextualAttention(nn.Module):
                 yi = yi.permute(0, 2, 1, 4, 3).contiguous()
             yi = yi.view(1, int_bs[2] * int_bs[3], int_fs[2], int_fs[3])  # (B=1, C=32*32, H=32, W=32)
             # softmax to match
-            yi = yi * mm
-            yi = F.softmax(yi*scale, dim=1)
-            yi = yi * mm  # [1, L, H, W]
+            yi = self._masked_softmax(yi, mmi)  # [1, L, H, W]
 
             offset = torch.argmax(yi, dim=1, keepdim=True)  # 1*1*H*W
 
-            if int_bs != int_fs:
-                # Normalize the offset value to match foreground dimension
-                times = float(int_fs[2] * int_fs[3]) / float(int_bs[2] * int_bs[3])
-                offset = ((offset + 1).float() * times - 1).to(torch.int64)
-            offset = torch.cat([offset//int_fs[3], offset%int_fs[3]], dim=1)  # 1*2*H*W
-
             # deconv for patch pasting
             wi_center = raw_wi[0]
             # yi = F.pad(yi, [0, 1, 0, 1])    # here may need conv_transpose same padding
@@ -324,32 +913,9 @@ class ContextualAttention(nn.Module):
             offsets.append(offset)
 
         y = torch.cat(y, dim=0)  # back to the mini-batch
-        y.contiguous().view(raw_int_fs)
-
         offsets = torch.cat(offsets, dim=0)
-        offsets = offsets.view(int_fs[0], 2, *int_fs[2:])
-
-        # case1: visualize optical flow: minus current position
-        h_add = torch.arange(int_fs[2]).view([1, 1, int_fs[2], 1]).expand(int_fs[0], -1, -1, int_fs[3])
-        w_add = torch.arange(int_fs[3]).view([1, 1, 1, int_fs[3]]).expand(int_fs[0], -1, int_fs[2], -1)
-        ref_coordinate = torch.cat([h_add, w_add], dim=1)
-        if self.use_cuda:
-            ref_coordinate = ref_coordinate.cuda()
-
-        offsets = offsets - ref_coordinate
-        # flow = pt_flow_to_image(offsets)
-
-        flow = torch.from_numpy(flow_to_image(offsets.permute(0, 2, 3, 1).cpu().data.numpy())) / 255.
-        flow = flow.permute(0, 3, 1, 2)
-        if self.use_cuda:
-            flow = flow.cuda()
-        # case2: visualize which pixels are attended
-        # flow = torch.from_numpy(highlight_flow((offsets * mask.long()).cpu().data.numpy()))
-
-        if self.rate != 1:
-            flow = F.interpolate(flow, scale_factor=self.rate*4, mode='nearest')
 
-        return y, flow
+        return y, offsets
 
 
 def test_contextual_attention(args):
@@ -395,8 +961,113 @@ def test_contextual_attention(args):
     # cv2.imwrite('flow' + args.imageOut, flow_t)
 
 
+def test_contextual_attention_engines(batch_size=4, size=64, channels=32, atol=1e-4):
+    """Check that every attention engine reproduces the per-sample loop.
+
+    The engines sum the scores in different orders, which differs by a
+    few 1e-5 in fp32 (they agree to 1e-14 in fp64).
+    """
+    torch.manual_seed(0)
+    f = torch.randn(batch_size, channels, size, size)
+    # the mask lives at the image resolution, 4x the feature resolution,
+    # and every sample has its own hole
+    mask = torch.zeros(batch_size, 1, size*4, size*4)
+    for i in range(batch_size):
+        mask[i, :, size + 8*i:size*2 + 8*i, size - 8*i:size*3 - 8*i] = 1.
+
+    reference = ContextualAttention(ksize=3, stride=1, rate=2, fuse=True, engine='loop')
+    y_ref, flow_ref = reference(f, f, mask)
+    for engine in ['conv', 'gemm']:
+        attention = ContextualAttention(ksize=3, stride=1, rate=2, fuse=True, engine=engine)
+        y, flow = attention(f, f, mask)
+        diff = (y - y_ref).abs().max().item()
+        # near-ties in the argmax may flip, so the flow is only reported
+        flow_diff = (flow != flow_ref).float().mean().item()
+        print('{}: max abs diff {:.3e}, flow mismatch {:.2%}'.format(engine, diff, flow_diff))
+        assert diff < atol, "Attention engine {} does not match the reference loop".format(engine)
+
+    # a batch-1 mask is shared by all the samples
+    for engine in ['loop', 'conv', 'gemm']:
+        attention = ContextualAttention(ksize=3, stride=1, rate=2, fuse=True, engine=engine)
+        y, _ = attention(f, f, mask[:1], return_flow=False)
+        y_shared, _ = reference(f, f, mask[:1].expand(batch_size, -1, -1, -1), return_flow=False)
+        diff = (y - y_shared).abs().max().item()
+        print('{} with a shared mask: max abs diff {:.3e}'.format(engine, diff))
+        assert y.size(0) == batch_size and diff < atol, \
+            "Attention engine {} does not share a batch-1 mask".format(engine)
+
+    # the margin 1 covers the pasted patches of the hole
+    attention = ContextualAttention(ksize=3, stride=1, rate=2, fuse=True, masked_only=True, masked_margin=1)
+    y, flow = attention(f, f, mask)
+    hole = F.max_pool2d(mask, 8, stride=8, ceil_mode=True)
+    hole = F.interpolate(hole, size=list(y.size()[2:]), mode='nearest')
+    diff = ((y - y_ref) * hole).abs().max().item()
+    print('masked_only: max abs diff inside the hole {:.3e}'.format(diff))
+    assert diff < atol, "Masked-only attention does not match the reference loop inside the hole"
+
+    # small tiles so that the streaming softmax runs over several of them
+    attention = ContextualAttention(ksize=3, stride=1, rate=2, fuse=True, chunk_size=100, memory_budget=1)
+    y, flow = attention(f, f, mask)
+    diff = (y - y_ref).abs().max().item()
+    print('tiled: max abs diff {:.3e}'.format(diff))
+    assert diff < atol, "Tiled attention does not match the reference loop"
+
+
+def test_masked_only_generator(batch_size=2, size=128, atol=1e-4):
+    """Check that the masked-only attention does not change the inpainted pixels of the Generator."""
+    torch.manual_seed(0)
+    netG = Generator({'input_dim': 3, 'ngf': 16}, False).eval()
+    x = torch.randn(batch_size, 3, size, size)
+    mask = torch.zeros(batch_size, 1, size, size)
+    for i in range(batch_size):
+        mask[i, :, size // 4 + 5 * i:size // 2 + 5 * i, size // 3:size * 3 // 4 - 3 * i] = 1.
+    with torch.no_grad():
+        _, x2_ref, _ = netG(x, mask, return_flow=False)
+        netG.fine_generator.contextul_attention.masked_only = True
+        _, x2, _ = netG(x, mask, return_flow=False)
+    diff = ((x2 - x2_ref) * mask).abs().max().item()
+    print('masked_only generator: max abs diff inside the hole {:.3e}'.format(diff))
+    assert diff < atol, "Masked-only attention changes the inpainted pixels of the Generator"
+    return x2
+
+
+def test_fuse_for_inference(batch_size=2, size=128):
+    """Check the output of the fused Generator, with and without channels_last."""
+    torch.manual_seed(0)
+    netG = Generator({'input_dim': 3, 'ngf': 16}, False).eval()
+    x = torch.randn(batch_size, 3, size, size)
+    mask = torch.zeros(batch_size, 1, size, size)
+    mask[:, :, size // 4:size // 2, size // 4:size * 3 // 4] = 1.
+    with torch.no_grad():
+        reference = netG(x, mask, return_flow=False)[1]
+        for channels_last, atol in [(False, 1e-6), (True, 1e-5)]:
+            fused = copy.deepcopy(netG).fuse_for_inference(channels_last=channels_last)
+            diff = (fused(x, mask, return_flow=False)[1] - reference).abs().max().item()
+            print('fused, channels_last={}: max abs diff {:.3e}'.format(channels_last, diff))
+            assert diff < atol, "The fused Generator changes the output (channels_last={})".format(channels_last)
+    return reference
+
+
+def test_concurrent_branches_autocast(size=64):
+    """Check that both FineGenerator branches run in bf16 under CPU autocast when run concurrently."""
+    torch.manual_seed(0)
+    netG = Generator({'input_dim': 3, 'ngf': 16}, False).eval()
+    fine = netG.fine_generator
+    x = torch.randn(1, 16, size, size)
+    mask = torch.zeros(1, 1, size, size)
+    mask[:, :, size // 4:size // 2, size // 4:size // 2] = 1.
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16):
+        x_hallu, (pm, _) = run_concurrently(lambda: fine.conv_branch(x),
+                                            lambda: fine.attention_branch(x, mask, False),
+                                            x.device)
+    print('concurrent branches under bf16 autocast: conv {}, attention {}'.format(x_hallu.dtype, pm.dtype))
+    assert x_hallu.dtype == torch.bfloat16, "The conv branch does not run under autocast"
+    assert pm.dtype == torch.bfloat16, "The attention branch does not run under autocast"
+    return x_hallu, pm
+
+
 class LocalDis(nn.Module):
-    def __init__(self, config, use_cuda=True):
+    def __init__(self, config, use_cuda=True, device_ids=None):
         super(LocalDis, self).__init__()
         self.input_dim = config['input_dim']
         self.cnum = config['ndf']
@@ -414,7 +1085,7 @@ class LocalDis(nn.Module):
 
 
 class GlobalDis(nn.Module):
-    def __init__(self, config, use_cuda=True):
+    def __init__(self, config, use_cuda=True, device_ids=None):
         super(GlobalDis, self).__init__()
         self.input_dim = config['input_dim']
         self.cnum = config['ndf']
@@ -464,6 +1135,39 @@ def dis_conv(input_dim, output_dim, kernel_size=5, stride=2, padding=0, rate=1,
                        activation=activation)
 
 
+def concat_conv_blocks(blocks, x):
+    """Run Conv2dBlocks with the same conv shape on the same input as one wide conv.
+
+    The weights are concatenated on the fly, so the blocks keep their own
+    parameters and gradients. Blocks with a weight or feature normalization
+    are run one by one.
+    Returns:
+        list: the output of every block
+    """
+    first = blocks[0]
+    convs = [block.conv for block in blocks]
+    if isinstance(first.conv, nn.ConvTranspose2d) or \
+            any(block.weight_norm or block.norm or type(block.pad) != type(first.pad) or
+                getattr(block.pad, 'padding', None) != getattr(first.pad, 'padding', None)
+                for block in blocks) or \
+            any((conv.kernel_size, conv.stride, conv.padding, conv.dilation) !=
+                (convs[0].kernel_size, convs[0].stride, convs[0].padding, convs[0].dilation)
+                for conv in convs):
+        return [block(x) for block in blocks]
+    if first.pad:
+        x = first.pad(x)
+    weight = torch.cat([conv.weight for conv in convs], dim=0)
+    bias = torch.cat([conv.bias for conv in convs], dim=0)
+    y = F.conv2d(x, weight, bias, convs[0].stride, convs[0].padding, convs[0].dilation)
+    if all(repr(block.activation) == repr(first.activation) for block in blocks):
+        if first.activation:
+            y = first.activation(y)
+        return list(torch.split(y, [conv.out_channels for conv in convs], dim=1))
+    # the views of y share a version counter, in-place activations need their own copy
+    y = torch.split(y, [conv.out_channels for conv in convs], dim=1)
+    return [block.activation(yi.clone()) if block.activation else yi for block, yi in zip(blocks, y)]
+
+
 class Conv2dBlock(nn.Module):
     def __init__(self, input_dim, output_dim, kernel_size, stride, padding=0,
                  conv_padding=0, dilation=1, weight_norm='none', norm='none',
@@ -536,6 +1240,19 @@ class Conv2dBlock(nn.Module):
         if self.weight_norm:
             self.conv = self.weight_norm(self.conv)
 
+    def fuse_for_inference(self):
+        """Fold a symmetric zero padding into the padding of the conv.
+
+        The conv then pads internally, which gives the same output without
+        the separate pad kernel and its padded copy of the input. Only
+        meant for inference.
+        """
+        if isinstance(self.pad, nn.ZeroPad2d) and not isinstance(self.conv, nn.ConvTranspose2d):
+            left, right, top, bottom = self.pad.padding
+            if left == right and top == bottom:
+                self.conv.padding = (self.conv.padding[0] + top, self.conv.padding[1] + left)
+                self.pad = None
+
     def forward(self, x):
         if self.pad:
             x = self.conv(self.pad(x))
@@ -555,5 +1272,12 @@ if __name__ == "__main__":
     parser.add_argument('--imageA', default='', type=str, help='Image A as background patches to reconstruct image B.')
     parser.add_argument('--imageB', default='', type=str, help='Image B is reconstructed with image A.')
     parser.add_argument('--imageOut', default='result.png', type=str, help='Image B is reconstructed with image A.')
+    parser.add_argument('--engines', action='store_true', help='Check the attention engines against the reference loop.')
     args = parser.parse_args()
-    test_contextual_attention(args)
+    if args.engines:
+        test_contextual_attention_engines()
+        test_masked_only_generator()
+        test_concurrent_branches_autocast()
+        test_fuse_for_inference()
+    else:
+        test_contextual_attention(args)
@@ -0,0 +1,113 @@
+import os
+import random
+from argparse import ArgumentParser
+
+import torch
+import torch.backends.cudnn as cudnn
+import torchvision.utils as vutils
+
+from model.inference import InpaintEngine, attention_options
+from utils.tools import get_config, is_image_file
+
+
+parser = ArgumentParser()
+parser.add_argument('--config', type=str, default='configs/config.yaml',
+                    help="training configuration")
+parser.add_argument('--seed', type=int, help='manual seed')
+parser.add_argument('--image_dir', type=str, help='directory of images to inpaint')
+parser.add_argument('--mask', type=str, default='', help='mask used for every image')
+parser.add_argument('--mask_dir', type=str, default='',
+                    help='directory of masks with the same file names as the images')
+parser.add_argument('--output_dir', type=str, default='outputs')
+parser.add_argument('--checkpoint_path', type=str, default='')
+parser.add_argument('--iter', type=int, default=0)
+parser.add_argument('--batch_size', type=int, default=8)
+parser.add_argument('--native_size', action='store_true',
+                    help='inpaint the images at their own size instead of resizing to image_shape')
+parser.add_argument('--roi', action='store_true',
+                    help='only run the network on windows around the holes, at native size')
+parser.add_argument('--context', type=float, default=2.,
+                    help='window size over the hole size for --roi')
+parser.add_argument('--tile_size', type=int, default=0,
+                    help='inpaint at native size with overlapping tiles of this size (e.g. 256 or 512)')
+parser.add_argument('--overlap', type=int, default=32, help='overlap of the tiles in pixels')
+parser.add_argument('--blend', type=str, default='cosine', help='tile blending: linear | cosine')
+parser.add_argument('--cascade', type=str, default='full',
+                    help='generator stages to run: full | coarse | adaptive')
+parser.add_argument('--min_hole_area', type=float, default=0.01,
+                    help='adaptive cascade: skip the fine stage below this hole area fraction')
+parser.add_argument('--max_coarse_error', type=float, default=None,
+                    help='adaptive cascade: skip the fine stage below this coarse error around the hole')
+parser.add_argument('--attention_engine', type=str, default=None,
+                    help='ContextualAttention engine: conv | gemm | loop, defaults to the config')
+parser.add_argument('--masked_only', action='store_true', default=None,
+                    help='only match the attention around the holes')
+parser.add_argument('--chunk_size', type=int, default=None,
+                    help='tiled attention: foreground positions per score tile')
+parser.add_argument('--memory_budget', type=int, default=None,
+                    help='tiled attention: MB per score tile, e.g. 256 for 2K images on the CPU')
+
+
+def main():
+    args = parser.parse_args()
+    config = get_config(args.config)
+    cudnn.benchmark = True
+
+    print("Arguments: {}".format(args))
+
+    # Set random seed
+    if args.seed is None:
+        args.seed = random.randint(1, 10000)
+    print("Random seed: {}".format(args.seed))
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # Set checkpoint path
+    if not args.checkpoint_path:
+        checkpoint_path = os.path.join('checkpoints',
+                                       config['dataset_name'],
+                                       config['mask_type'] + '_' + config['expname'])
+    else:
+        checkpoint_path = args.checkpoint_path
+
+    # The model is loaded once for the whole directory
+    engine = InpaintEngine(config, checkpoint_path, iteration=args.iter, batch_size=args.batch_size,
+                           native_size=args.native_size or args.roi or args.tile_size > 0,
+                           cascade=args.cascade, min_hole_area=args.min_hole_area,
+                           max_coarse_error=args.max_coarse_error, attention=attention_options(args))
+
+    names = sorted(f for f in os.listdir(args.image_dir) if is_image_file(f))
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # Only keep a few batches of decoded images in memory at a time
+    chunk = args.batch_size * 4
+    stats = []
+    for i in range(0, len(names), chunk):
+        pairs = []
+        for name in names[i:i + chunk]:
+            if args.mask_dir:
+                mask = os.path.join(args.mask_dir, name)
+            else:
+                mask = args.mask or None
+            pairs.append((os.path.join(args.image_dir, name), mask))
+        if args.tile_size > 0:
+            results = [engine.inpaint_tiled(*engine.load(image, mask), tile_size=args.tile_size,
+                                            overlap=args.overlap, blend=args.blend)
+                       for image, mask in pairs]
+        elif args.roi:
+            results = engine.inpaint_rois([engine.load(image, mask) for image, mask in pairs],
+                                          context=args.context)
+        else:
+            results = engine.inpaint(pairs, stats)
+        for name, inpainted_result in zip(names[i:i + chunk], results):
+            vutils.save_image(inpainted_result, os.path.join(args.output_dir, name),
+                              padding=0, normalize=True)
+        print("Inpainted {}/{} images".format(min(i + chunk, len(names)), len(names)))
+    if stats:
+        coarse = sum(1 for sample_stats in stats if sample_stats['path'] == 'coarse')
+        print("Coarse stage only for {}/{} images".format(coarse, len(stats)))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import torchvision.transforms as transforms
 import torchvision.utils as vutils
 
 from model.networks import Generator
+from model.inference import attention_options
 from utils.tools import get_config, random_bbox, mask_image, is_image_file, default_loader, normalize, get_model_list
 
 
@@ -22,13 +23,23 @@ parser.add_argument('--output', type=str, default='output.png')
 parser.add_argument('--flow', type=str, default='')
 parser.add_argument('--checkpoint_path', type=str, default='')
 parser.add_argument('--iter', type=int, default=0)
+parser.add_argument('--native_size', action='store_true',
+                    help='inpaint the image and --mask at their own size instead of resizing to image_shape')
+parser.add_argument('--attention_engine', type=str, default=None,
+                    help='ContextualAttention engine: conv | gemm | loop, defaults to the config')
+parser.add_argument('--masked_only', action='store_true', default=None,
+                    help='only match the attention around the holes')
+parser.add_argument('--chunk_size', type=int, default=None,
+                    help='tiled attention: foreground positions per score tile')
+parser.add_argument('--memory_budget', type=int, default=None,
+                    help='tiled attention: MB per score tile, e.g. 256 for 2K images on the CPU')
 
 def main():
     args = parser.parse_args()
     config = get_config(args.config)
 
     # CUDA configuration
-    cuda = True
+    cuda = config['cuda'] and torch.cuda.is_available()
     cudnn.benchmark = True
     device_ids = None # Unused
 
@@ -52,10 +63,11 @@ def main():
                     # Test a single masked image with a given mask
                     x = default_loader(args.image)
                     mask = default_loader(args.mask)
-                    x = transforms.Resize(config['image_shape'][:-1])(x)
-                    x = transforms.CenterCrop(config['image_shape'][:-1])(x)
-                    mask = transforms.Resize(config['image_shape'][:-1])(mask)
-                    mask = transforms.CenterCrop(config['image_shape'][:-1])(mask)
+                    if not args.native_size:
+                        x = transforms.Resize(config['image_shape'][:-1])(x)
+                        x = transforms.CenterCrop(config['image_shape'][:-1])(x)
+                        mask = transforms.Resize(config['image_shape'][:-1])(mask)
+                        mask = transforms.CenterCrop(config['image_shape'][:-1])(mask)
                     x = transforms.ToTensor()(x)
                     mask = transforms.ToTensor()(mask)[0].unsqueeze(dim=0)
                     x = normalize(x)
@@ -88,20 +100,22 @@ def main():
                     checkpoint_path = args.checkpoint_path
 
                 # Define the trainer
-                netG = Generator(config['netG'], cuda).cuda()
+                netG_config = dict(config['netG'])
+                netG_config['attention'] = dict(netG_config.get('attention') or {}, **attention_options(args))
+                netG = Generator(netG_config, cuda)
                 # Resume weight
                 last_model_name = get_model_list(checkpoint_path, "gen", iteration=args.iter)
-                netG.load_state_dict(torch.load(last_model_name))
+                netG.load_state_dict(torch.load(last_model_name, map_location='cpu'))
                 model_iteration = int(last_model_name[-11:-3])
                 print("Resume from {} at iteration {}".format(checkpoint_path, model_iteration))
 
                 if cuda:
-                    netG = nn.parallel.DataParallel(netG, device_ids=device_ids)
+                    netG = nn.parallel.DataParallel(netG.cuda(), device_ids=device_ids)
                     x = x.cuda()
                     mask = mask.cuda()
 
                 # Inference
-                x1, x2, offset_flow = netG(x, mask)
+                x1, x2, offset_flow = netG(x, mask, return_flow=bool(args.flow))
                 print(mask)
                 inpainted_result = x2 * mask + x * (1. - mask)
 
@@ -32,13 +32,13 @@ def main():
     trainer.eval()
 
     image = imageio.imread(args.image)
-    image = torch.FloatTensor(image).permute(2, 0, 1).unsqueeze(0).cuda()
+    image = torch.FloatTensor(image).permute(2, 0, 1).unsqueeze(0).to(device)
     mask = imageio.imread(args.mask)
-    mask = (torch.FloatTensor(mask[:, :, 0]) / 255).unsqueeze(0).unsqueeze(0).cuda()
+    mask = (torch.FloatTensor(mask[:, :, 0]) / 255).unsqueeze(0).unsqueeze(0).to(device)
 
-    x = (image / 127.5 - 1) * (1 - mask).cuda()
+    x = (image / 127.5 - 1) * (1 - mask)
     with torch.no_grad():
-        _, result, _ = trainer.netG(x, mask)
+        _, result, _ = trainer.netG(x, mask, return_flow=False)
 
     imageio.imwrite(args.output, upcast(result[0].permute(1, 2, 0).detach().cpu().numpy()))
 
@@ -12,7 +12,8 @@ from tensorboardX import SummaryWriter
 
 from trainer import Trainer
 from data.dataset import Dataset
-from utils.tools import get_config, random_bbox, mask_image
+from data.mask_bank import MaskBank
+from utils.tools import get_config, random_bbox, mask_image, normalize_uint8
 from utils.logger import get_logger
 
 parser = ArgumentParser()
@@ -63,7 +64,8 @@ def main():
         train_dataset = Dataset(data_path=config['train_data_path'],
                                 with_subfolder=config['data_with_subfolder'],
                                 image_shape=config['image_shape'],
-                                random_crop=config['random_crop'])
+                                random_crop=config['random_crop'],
+                                uint8=config.get('uint8_images', False))
         # val_dataset = Dataset(data_path=config['val_data_path'],
         #                       with_subfolder=config['data_with_subfolder'],
         #                       image_size=config['image_size'],
@@ -71,7 +73,8 @@ def main():
         train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                    batch_size=config['batch_size'],
                                                    shuffle=True,
-                                                   num_workers=config['num_workers'])
+                                                   num_workers=config['num_workers'],
+                                                   pin_memory=cuda)
         # val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
         #                                           batch_size=config['batch_size'],
         #                                           shuffle=False,
@@ -93,6 +96,10 @@ def main():
         start_iteration = trainer_module.resume(config['resume']) if config['resume'] else 1
 
         iterable_train_loader = iter(train_loader)
+        # seeded generator of the random boxes and masks, they are drawn on the training device
+        mask_generator = torch.Generator(device='cuda' if cuda else 'cpu')
+        mask_generator.manual_seed(args.seed)
+        mask_bank = MaskBank(config['mask_bank']) if config.get('mask_bank') else None
 
         time_count = time.time()
 
@@ -103,37 +110,21 @@ def main():
                 iterable_train_loader = iter(train_loader)
                 ground_truth = next(iterable_train_loader)
 
-            # Prepare the inputs
-            bboxes = random_bbox(config, batch_size=ground_truth.size(0))
-            x, mask = mask_image(ground_truth, bboxes, config)
+            # Prepare the inputs, the masks are built on the GPU
             if cuda:
-                x = x.cuda()
-                mask = mask.cuda()
-                ground_truth = ground_truth.cuda()
+                ground_truth = ground_truth.cuda(non_blocking=True)
+            if config.get('uint8_images', False):
+                ground_truth = normalize_uint8(ground_truth)
+            bboxes = random_bbox(config, batch_size=ground_truth.size(0), generator=mask_generator)
+            x, mask = mask_image(ground_truth, bboxes, config, generator=mask_generator, mask_bank=mask_bank)
 
-            ###### Forward pass ######
+            ###### Forward and backward passes ######
             compute_g_loss = iteration % config['n_critic'] == 0
-            losses, inpainted_result, offset_flow = trainer(x, bboxes, mask, ground_truth, compute_g_loss)
-            # Scalars from different devices are gathered into vectors
-            for k in losses.keys():
-                if not losses[k].dim() == 0:
-                    losses[k] = torch.mean(losses[k])
-
-            ###### Backward pass ######
-            # Update D
-            trainer_module.optimizer_d.zero_grad()
-            losses['d'] = losses['wgan_d'] + losses['wgan_gp'] * config['wgan_gp_lambda']
-            losses['d'].backward()
-            trainer_module.optimizer_d.step()
-
-            # Update G
-            if compute_g_loss:
-                trainer_module.optimizer_g.zero_grad()
-                losses['g'] = losses['l1'] * config['l1_loss_alpha'] \
-                              + losses['ae'] * config['ae_loss_alpha'] \
-                              + losses['wgan_g'] * config['gan_loss_alpha']
-                losses['g'].backward()
-                trainer_module.optimizer_g.step()
+            # the offset flow is only needed for visualization
+            return_flow = iteration % config['viz_iter'] == 0
+            # forward and backward passes, over config['accumulation_steps'] micro-batches
+            losses, inpainted_result, offset_flow = trainer_module.train_step(
+                x, bboxes, mask, ground_truth, compute_g_loss, return_flow, model=trainer)
 
             # Log and visualization
             log_losses = ['l1', 'ae', 'wgan_g', 'wgan_d', 'wgan_gp', 'g', 'd']
@@ -141,6 +132,10 @@ def main():
                 time_count = time.time() - time_count
                 speed = config['print_iter'] / time_count
                 speed_msg = 'speed: %.2f batches/s ' % speed
+                if cuda:
+                    speed_msg += 'memory: %.0f MB ' % (torch.cuda.max_memory_allocated() / 2**20)
+                    torch.cuda.reset_peak_memory_stats()
+                speed_msg += 'amp: %s ' % trainer_module.amp
                 time_count = time.time()
 
                 message = 'Iter: [%d/%d] ' % (iteration, config['niter'])
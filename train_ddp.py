@@ -0,0 +1,239 @@
+"""
+Multi-process training with DistributedDataParallel, one process per GPU.
+Usage:
+    torchrun --nproc_per_node 4 train_ddp.py --config configs/config.yaml
+    python train_ddp.py --config configs/config.yaml --nprocs 2
+Without torchrun, --nprocs local processes are spawned, which also works on
+the CPU with the gloo backend (set cuda: False in the config).
+"""
+
+import os
+import random
+import time
+import shutil
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.backends.cudnn as cudnn
+import torchvision.utils as vutils
+from tensorboardX import SummaryWriter
+
+from trainer import Trainer
+from data.dataset import Dataset
+from data.mask_bank import MaskBank
+from utils.tools import get_config, random_bbox, mask_image, normalize_uint8
+from utils.logger import get_logger
+
+parser = ArgumentParser()
+parser.add_argument('--config', type=str, default='configs/config.yaml',
+                    help="training configuration")
+parser.add_argument('--seed', type=int, help='manual seed')
+parser.add_argument('--nprocs', type=int, default=2,
+                    help='number of local processes to spawn when not started by torchrun')
+parser.add_argument('--backend', type=str, default='',
+                    help='nccl | gloo, defaults to nccl with cuda and gloo otherwise')
+parser.add_argument('--master_port', type=str, default='29500',
+                    help='port of the rank 0 process for the spawned processes')
+
+
+def main():
+    args = parser.parse_args()
+    if 'RANK' in os.environ:
+        # started by torchrun
+        train(int(os.environ['LOCAL_RANK']), int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), args)
+    else:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', args.master_port)
+        # the spawned processes get the same base seed
+        if args.seed is None:
+            args.seed = random.randint(1, 10000)
+        mp.spawn(train_spawned, args=(args,), nprocs=args.nprocs)
+
+
+def train_spawned(rank, args):
+    train(rank, rank, args.nprocs, args)
+
+
+def train(local_rank, rank, world_size, args):
+    config = get_config(args.config)
+
+    # CUDA configuration, one GPU per process
+    cuda = config['cuda'] and torch.cuda.is_available()
+    config['cuda'] = cuda
+    dist.init_process_group(args.backend or ('nccl' if cuda else 'gloo'),
+                            rank=rank, world_size=world_size)
+    if cuda:
+        device_ids = config['gpu_ids']
+        gpu = device_ids[local_rank] if local_rank < len(device_ids) else local_rank
+        torch.cuda.set_device(gpu)
+        config['gpu_ids'] = [gpu]
+        device = torch.device('cuda', gpu)
+        cudnn.benchmark = True
+    else:
+        device = torch.device('cpu')
+    is_main = rank == 0
+
+    # the same base seed for all the ranks, so that the DistributedSampler
+    # shards are the same permutation: torchrun processes draw their own
+    if args.seed is None:
+        args.seed = random.randint(1, 10000)
+    seed_tensor = torch.tensor([args.seed], dtype=torch.int64, device=device)
+    dist.broadcast(seed_tensor, src=0)
+    args.seed = int(seed_tensor.item())
+
+    # config['batch_size'] is the total batch size, as with DataParallel
+    assert config['batch_size'] % world_size == 0, "batch_size has to be divisible by the number of processes"
+    batch_size = config['batch_size'] // world_size
+
+    # Configure checkpoint path
+    checkpoint_path = os.path.join('checkpoints',
+                                   config['dataset_name'],
+                                   config['mask_type'] + '_' + config['expname'])
+    if is_main:
+        if not os.path.exists(checkpoint_path):
+            os.makedirs(checkpoint_path)
+        shutil.copy(args.config, os.path.join(checkpoint_path, os.path.basename(args.config)))
+        writer = SummaryWriter(logdir=checkpoint_path)
+        logger = get_logger(checkpoint_path)    # get logger and configure it at the first call
+    else:
+        writer = None
+        # the root logger without handlers drops the info messages of the other ranks
+        logger = get_logger()
+
+    logger.info("Arguments: {}".format(args))
+    logger.info("World size: {}, batch size per process: {}".format(world_size, batch_size))
+    # Set a different random seed per rank, for the masks and the augmentations,
+    # the data order comes from the shared base seed of the DistributedSampler
+    seed = args.seed + rank
+    logger.info("Random seed: {} + rank".format(args.seed))
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if cuda:
+        torch.cuda.manual_seed(seed)
+
+    # Log the configuration
+    logger.info("Configuration: {}".format(config))
+
+    try:  # for unexpected error logging
+        # Load the dataset
+        logger.info("Training on dataset: {}".format(config['dataset_name']))
+        train_dataset = Dataset(data_path=config['train_data_path'],
+                                with_subfolder=config['data_with_subfolder'],
+                                image_shape=config['image_shape'],
+                                random_crop=config['random_crop'],
+                                uint8=config.get('uint8_images', False))
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset,
+                                                                        num_replicas=world_size,
+                                                                        rank=rank,
+                                                                        shuffle=True,
+                                                                        seed=args.seed)
+        # every rank has to run the same number of iterations
+        train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
+                                                   batch_size=batch_size,
+                                                   sampler=train_sampler,
+                                                   num_workers=config['num_workers'],
+                                                   pin_memory=cuda,
+                                                   drop_last=True)
+
+        # Define the trainer
+        trainer = Trainer(config)
+        logger.info("\n{}".format(trainer.netG))
+        logger.info("\n{}".format(trainer.localD))
+        logger.info("\n{}".format(trainer.globalD))
+
+        # Get the resume iteration to restart training, before DDP broadcasts the weights of rank 0
+        start_iteration = trainer.resume(config['resume']) if config['resume'] else 1
+        trainer.distribute([device.index] if cuda else None)
+
+        epoch = 0
+        train_sampler.set_epoch(epoch)
+        iterable_train_loader = iter(train_loader)
+        # seeded generator of the random boxes and masks, different on every rank,
+        # they are drawn on the training device
+        mask_generator = torch.Generator(device=device)
+        mask_generator.manual_seed(seed)
+        mask_bank = MaskBank(config['mask_bank']) if config.get('mask_bank') else None
+
+        time_count = time.time()
+
+        for iteration in range(start_iteration, config['niter'] + 1):
+            try:
+                ground_truth = next(iterable_train_loader)
+            except StopIteration:
+                epoch += 1
+                train_sampler.set_epoch(epoch)
+                iterable_train_loader = iter(train_loader)
+                ground_truth = next(iterable_train_loader)
+
+            # Prepare the inputs, the masks are built on the device
+            ground_truth = ground_truth.to(device, non_blocking=True)
+            if config.get('uint8_images', False):
+                ground_truth = normalize_uint8(ground_truth)
+            bboxes = random_bbox(config, batch_size=ground_truth.size(0), generator=mask_generator)
+            x, mask = mask_image(ground_truth, bboxes, config, generator=mask_generator, mask_bank=mask_bank)
+
+            ###### Forward and backward passes ######
+            compute_g_loss = iteration % config['n_critic'] == 0
+            # the offset flow is only needed for the visualization on rank 0
+            return_flow = is_main and iteration % config['viz_iter'] == 0
+            # forward and backward passes, over config['accumulation_steps'] micro-batches
+            losses, inpainted_result, offset_flow = trainer.train_step(x, bboxes, mask, ground_truth,
+                                                                       compute_g_loss, return_flow)
+
+            # Log and visualization
+            log_losses = ['l1', 'ae', 'wgan_g', 'wgan_d', 'wgan_gp', 'g', 'd']
+            if iteration % config['print_iter'] == 0:
+                # average the losses over the ranks, every rank takes part
+                values = torch.stack([losses.get(k, x.new_zeros(())).detach().float() for k in log_losses])
+                dist.all_reduce(values)
+                values = (values / world_size).tolist()
+
+                time_count = time.time() - time_count
+                speed = config['print_iter'] / time_count
+                speed_msg = 'speed: %.2f batches/s (x%d processes) ' % (speed, world_size)
+                if cuda:
+                    speed_msg += 'memory: %.0f MB ' % (torch.cuda.max_memory_allocated() / 2**20)
+                    torch.cuda.reset_peak_memory_stats()
+                time_count = time.time()
+
+                if is_main:
+                    message = 'Iter: [%d/%d] ' % (iteration, config['niter'])
+                    for k, v in zip(log_losses, values):
+                        writer.add_scalar(k, v, iteration)
+                        message += '%s: %.6f ' % (k, v)
+                    message += speed_msg
+                    logger.info(message)
+
+            if is_main and iteration % (config['viz_iter']) == 0:
+                viz_max_out = config['viz_max_out']
+                if x.size(0) > viz_max_out:
+                    viz_images = torch.stack([x[:viz_max_out], inpainted_result[:viz_max_out],
+                                              offset_flow[:viz_max_out]], dim=1)
+                else:
+                    viz_images = torch.stack([x, inpainted_result, offset_flow], dim=1)
+                viz_images = viz_images.view(-1, *list(x.size())[1:])
+                vutils.save_image(viz_images,
+                                  '%s/niter_%03d.png' % (checkpoint_path, iteration),
+                                  nrow=3 * 4,
+                                  normalize=True)
+
+            # Save the model
+            if is_main and iteration % config['snapshot_save_iter'] == 0:
+                trainer.save_model(checkpoint_path, iteration)
+
+    except Exception as e:  # for unexpected error logging
+        logger.error("Rank {}: {}".format(rank, e))
+        raise e
+    finally:
+        # tensorboardX's writer thread fails at exit if it is not closed
+        if writer is not None:
+            writer.close()
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
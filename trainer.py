@@ -1,4 +1,6 @@
 import os
+from contextlib import ExitStack, nullcontext
+
 import torch
 import torch.nn as nn
 from torch import autograd
@@ -32,24 +34,86 @@ class Trainer(nn.Module):
             self.localD.to(self.device_ids[0])
             self.globalD.to(self.device_ids[0])
 
-    def forward(self, x, bboxes, masks, ground_truth, compute_loss_g=False):
+        # mixed precision: 'fp16' on the GPU with loss scaling, or 'bf16'
+        self.amp = self.config.get('amp', 'none')
+        assert self.amp in ['none', 'fp16', 'bf16'], "Unsupported amp mode: {}".format(self.amp)
+        assert self.amp != 'fp16' or self.use_cuda, "fp16 autocast needs cuda, use bf16 on the CPU"
+        # one scaler per optimizer, they are pass-through unless fp16 is used
+        self.scaler_d = torch.cuda.amp.GradScaler(enabled=self.amp == 'fp16')
+        self.scaler_g = torch.cuda.amp.GradScaler(enabled=self.amp == 'fp16')
+        # DistributedDataParallel wrappers, see distribute()
+        self.ddp = None
+        # the spatial discounting mask of the local losses, see spatial_discounting_mask()
+        device = torch.device('cuda', self.device_ids[0]) if self.use_cuda else torch.device('cpu')
+        self.sd_mask_key = self.sd_mask_config()
+        self.register_buffer('sd_mask', spatial_discounting_mask(self.config, device=device), persistent=False)
+
+    def distribute(self, device_ids=None):
+        """Wrap netG and the discriminators in separate DistributedDataParallel modules.
+
+        The process group must be initialized. Only the main forward passes
+        go through the wrappers: the gradient penalty (a double backward)
+        runs the plain discriminators, its gradients are reduced with the
+        rest of the D loss.
+        """
+        ddp = nn.parallel.DistributedDataParallel
+        self.ddp = nn.ModuleDict({'netG': ddp(self.netG, device_ids=device_ids),
+                                  'localD': ddp(self.localD, device_ids=device_ids),
+                                  'globalD': ddp(self.globalD, device_ids=device_ids)})
+        return self
+
+    def sd_mask_config(self):
+        return (tuple(self.config['mask_shape']), self.config['spatial_discounting_gamma'],
+                self.config['discounted_mask'])
+
+    def spatial_discounting_mask(self, device):
+        """The cached spatial discounting mask on device.
+
+        The buffer follows the trainer across devices and DataParallel
+        replicas, it is only rebuilt when the mask configuration changes
+        or it is needed on another device.
+        """
+        key = self.sd_mask_config()
+        if key != self.sd_mask_key or self.sd_mask.device != device:
+            self.sd_mask = spatial_discounting_mask(self.config, device=device)
+            self.sd_mask_key = key
+        return self.sd_mask
+
+    def autocast(self):
+        """Autocast context of the configured mixed precision mode."""
+        if self.amp == 'none':
+            return nullcontext()
+        dtype = torch.float16 if self.amp == 'fp16' else torch.bfloat16
+        return torch.autocast(device_type='cuda' if self.use_cuda else 'cpu', dtype=dtype)
+
+    def forward(self, x, bboxes, masks, ground_truth, compute_loss_g=False, return_flow=True):
+        # the autocast state is thread local, so it is entered in every DataParallel replica
+        with self.autocast():
+            return self._forward(x, bboxes, masks, ground_truth, compute_loss_g, return_flow)
+
+    def _forward(self, x, bboxes, masks, ground_truth, compute_loss_g=False, return_flow=True):
         self.train()
         l1_loss = nn.L1Loss()
         losses = {}
+        netG, localD, globalD = self.netG, self.localD, self.globalD
+        if self.ddp is not None:
+            netG, localD, globalD = self.ddp['netG'], self.ddp['localD'], self.ddp['globalD']
 
-        x1, x2, offset_flow = self.netG(x, masks)
-        local_patch_gt = local_patch(ground_truth, bboxes)
+        # the critic-only iterations do not backpropagate through G
+        with torch.set_grad_enabled(compute_loss_g and torch.is_grad_enabled()):
+            x1, x2, offset_flow = netG(x, masks, return_flow)
         x1_inpaint = x1 * masks + x * (1. - masks)
         x2_inpaint = x2 * masks + x * (1. - masks)
-        local_patch_x1_inpaint = local_patch(x1_inpaint, bboxes)
-        local_patch_x2_inpaint = local_patch(x2_inpaint, bboxes)
+        local_patch_gt, local_patch_x1_inpaint, local_patch_x2_inpaint = local_patch(
+            [ground_truth, x1_inpaint, x2_inpaint], bboxes)
 
         # D part
-        # wgan d loss
+        # wgan d loss, the fakes are not detached so that the G loss reuses
+        # their predictions, accumulate_grads sends each loss to its own network
         local_patch_real_pred, local_patch_fake_pred = self.dis_forward(
-            self.localD, local_patch_gt, local_patch_x2_inpaint.detach())
+            localD, local_patch_gt, local_patch_x2_inpaint)
         global_real_pred, global_fake_pred = self.dis_forward(
-            self.globalD, ground_truth, x2_inpaint.detach())
+            globalD, ground_truth, x2_inpaint)
         losses['wgan_d'] = torch.mean(local_patch_fake_pred - local_patch_real_pred) + \
             torch.mean(global_fake_pred - global_real_pred) * self.config['global_wgan_loss_alpha']
         # gradients penalty loss
@@ -60,7 +124,7 @@ class Trainer(nn.Module):
 
         # G part
         if compute_loss_g:
-            sd_mask = spatial_discounting_mask(self.config)
+            sd_mask = self.spatial_discounting_mask(local_patch_gt.device)
             losses['l1'] = l1_loss(local_patch_x1_inpaint * sd_mask, local_patch_gt * sd_mask) * \
                 self.config['coarse_l1_alpha'] + \
                 l1_loss(local_patch_x2_inpaint * sd_mask, local_patch_gt * sd_mask)
@@ -69,15 +133,92 @@ class Trainer(nn.Module):
                 l1_loss(x2 * (1. - masks), ground_truth * (1. - masks))
 
             # wgan g loss
-            local_patch_real_pred, local_patch_fake_pred = self.dis_forward(
-                self.localD, local_patch_gt, local_patch_x2_inpaint)
-            global_real_pred, global_fake_pred = self.dis_forward(
-                self.globalD, ground_truth, x2_inpaint)
             losses['wgan_g'] = - torch.mean(local_patch_fake_pred) - \
                 torch.mean(global_fake_pred) * self.config['global_wgan_loss_alpha']
 
         return losses, x2_inpaint, offset_flow
 
+    def train_step(self, x, bboxes, masks, ground_truth, compute_loss_g=False, return_flow=True, model=None):
+        """One update of D, and of G if compute_loss_g, on a batch.
+
+        The batch is split into config['accumulation_steps'] micro-batches
+        whose gradients are accumulated before the optimizers step. Every
+        loss is a mean over the samples, so the micro-batch losses are
+        weighted by their share of the batch and the gradients (the gradient
+        penalty included) are those of the whole batch.
+        Args:
+            model: Module running `forward`, e.g. this trainer wrapped in
+                DataParallel, defaults to the trainer itself.
+        Returns:
+            tuple: (losses averaged over the batch, inpainted batch, offset flow or None)
+        """
+        model = model or self
+        steps = max(1, min(self.config.get('accumulation_steps', 1), x.size(0)))
+        micro_batch_size = -(-x.size(0) // steps)
+        micro_batches = list(zip(*[torch.split(t, micro_batch_size)
+                                   for t in (x, bboxes, masks, ground_truth)]))
+        self.zero_grads(compute_loss_g)
+        losses = {}
+        results = []
+        flows = []
+        for i, (xi, bboxes_i, masks_i, ground_truth_i) in enumerate(micro_batches):
+            weight = xi.size(0) / float(x.size(0))
+            # DDP only all-reduces the gradients of the last micro-batch
+            with self.no_sync(i < len(micro_batches) - 1):
+                losses_i, result, offset_flow = model(xi, bboxes_i, masks_i, ground_truth_i,
+                                                      compute_loss_g, return_flow)
+                # Scalars from different devices are gathered into vectors
+                for k in losses_i.keys():
+                    if not losses_i[k].dim() == 0:
+                        losses_i[k] = torch.mean(losses_i[k])
+                self.accumulate_grads(losses_i, compute_loss_g, weight)
+            for k, v in losses_i.items():
+                losses[k] = losses.get(k, 0.) + v.detach() * weight
+            results.append(result.detach())
+            if offset_flow is not None:
+                flows.append(offset_flow)
+        self.step(compute_loss_g)
+        return losses, torch.cat(results, dim=0), torch.cat(flows, dim=0) if flows else None
+
+    def zero_grads(self, compute_loss_g=False):
+        self.optimizer_d.zero_grad()
+        if compute_loss_g:
+            self.optimizer_g.zero_grad()
+
+    def accumulate_grads(self, losses, compute_loss_g=False, weight=1.):
+        """Add the gradients of the losses of `forward`, scaled by weight.
+
+        The G and D losses share the critic passes on the fakes, so every
+        loss is only backpropagated to the parameters of its own network.
+        The total losses are added to losses as 'd' and 'g'.
+        """
+        if compute_loss_g:
+            losses['g'] = losses['l1'] * self.config['l1_loss_alpha'] \
+                + losses['ae'] * self.config['ae_loss_alpha'] \
+                + losses['wgan_g'] * self.config['gan_loss_alpha']
+            torch.autograd.backward(self.scaler_g.scale(losses['g'] * weight),
+                                    inputs=list(self.netG.parameters()), retain_graph=True)
+        losses['d'] = losses['wgan_d'] + losses['wgan_gp'] * self.config['wgan_gp_lambda']
+        d_params = list(self.localD.parameters()) + list(self.globalD.parameters())
+        torch.autograd.backward(self.scaler_d.scale(losses['d'] * weight), inputs=d_params)
+
+    def step(self, compute_loss_g=False):
+        """Update D, and G if compute_loss_g, once all the gradients are accumulated."""
+        self.scaler_d.step(self.optimizer_d)
+        self.scaler_d.update()
+        if compute_loss_g:
+            self.scaler_g.step(self.optimizer_g)
+            self.scaler_g.update()
+
+    def no_sync(self, skip=True):
+        """Context skipping the DDP gradient all-reduce of the backward passes run in it."""
+        if self.ddp is None or not skip:
+            return nullcontext()
+        stack = ExitStack()
+        for module in self.ddp.values():
+            stack.enter_context(module.no_sync())
+        return stack
+
     def dis_forward(self, netD, ground_truth, x_inpaint):
         assert ground_truth.size() == x_inpaint.size()
         batch_size = ground_truth.size(0)
@@ -90,32 +231,33 @@ class Trainer(nn.Module):
     # Calculate gradient penalty
     def calc_gradient_penalty(self, netD, real_data, fake_data):
         batch_size = real_data.size(0)
-        alpha = torch.rand(batch_size, 1, 1, 1)
+        alpha = torch.rand(batch_size, 1, 1, 1, device=real_data.device, dtype=real_data.dtype)
         alpha = alpha.expand_as(real_data)
-        if self.use_cuda:
-            alpha = alpha.cuda()
 
         interpolates = alpha * real_data + (1 - alpha) * fake_data
         interpolates = interpolates.requires_grad_().clone()
 
         disc_interpolates = netD(interpolates)
-        grad_outputs = torch.ones(disc_interpolates.size())
-
-        if self.use_cuda:
-            grad_outputs = grad_outputs.cuda()
+        # with fp16 the output is scaled like the loss so that the gradients
+        # do not underflow, and unscaled before the penalty
+        disc_interpolates = self.scaler_d.scale(disc_interpolates)
+        grad_outputs = torch.ones_like(disc_interpolates)
 
         gradients = autograd.grad(outputs=disc_interpolates, inputs=interpolates,
                                   grad_outputs=grad_outputs, create_graph=True,
                                   retain_graph=True, only_inputs=True)[0]
+        if self.scaler_d.is_enabled():
+            gradients = gradients / self.scaler_d.get_scale()
 
-        gradients = gradients.view(batch_size, -1)
+        # the norm is computed in fp32 whatever the autocast mode
+        gradients = gradients.float().view(batch_size, -1)
         gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
 
         return gradient_penalty
 
-    def inference(self, x, masks):
+    def inference(self, x, masks, return_flow=True):
         self.eval()
-        x1, x2, offset_flow = self.netG(x, masks)
+        x1, x2, offset_flow = self.netG(x, masks, return_flow)
         # x1_inpaint = x1 * masks + x * (1. - masks)
         x2_inpaint = x2 * masks + x * (1. - masks)
 
@@ -130,7 +272,9 @@ class Trainer(nn.Module):
         torch.save({'localD': self.localD.state_dict(),
                     'globalD': self.globalD.state_dict()}, dis_name)
         torch.save({'gen': self.optimizer_g.state_dict(),
-                    'dis': self.optimizer_d.state_dict()}, opt_name)
+                    'dis': self.optimizer_d.state_dict(),
+                    'scaler_g': self.scaler_g.state_dict(),
+                    'scaler_d': self.scaler_d.state_dict()}, opt_name)
 
     def resume(self, checkpoint_dir, iteration=0, test=False):
         # Load generators
@@ -148,6 +292,9 @@ class Trainer(nn.Module):
             state_dict = torch.load(os.path.join(checkpoint_dir, 'optimizer.pt'))
             self.optimizer_d.load_state_dict(state_dict['dis'])
             self.optimizer_g.load_state_dict(state_dict['gen'])
+            if 'scaler_d' in state_dict:
+                self.scaler_d.load_state_dict(state_dict['scaler_d'])
+                self.scaler_g.load_state_dict(state_dict['scaler_g'])
 
         print("Resume from {} at iteration {}".format(checkpoint_dir, iteration))
         logger.info("Resume from {} at iteration {}".format(checkpoint_dir, iteration))
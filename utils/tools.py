@@ -1,21 +1,26 @@
 import os
+import math
 import torch
 import yaml
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw
 
 import torch.nn.functional as F
 
 
-def pil_loader(path):
+def pil_loader(path, draft_size=None):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     with open(path, 'rb') as f:
         img = Image.open(f)
+        if draft_size is not None:
+            # JPEGs are decoded at 1/2, 1/4 or 1/8 scale when the result is
+            # still at least draft_size (width, height), a no-op otherwise
+            img.draft('RGB', draft_size)
         return img.convert('RGB')
 
 
-def default_loader(path):
-    return pil_loader(path)
+def default_loader(path, draft_size=None):
+    return pil_loader(path, draft_size)
 
 
 def tensor_img_to_npimg(tensor_img):
@@ -36,6 +41,11 @@ def tensor_img_to_npimg(tensor_img):
 def normalize(x):
     return x.mul_(2).add_(-1)
 
+
+def normalize_uint8(x):
+    """Normalize uint8 images to [-1, 1] floats, as ToTensor and normalize do."""
+    return normalize(x.to(torch.float32).div_(255))
+
 def same_padding(images, ksizes, strides, rates):
     assert len(images.size()) == 4
     batch_size, channel, rows, cols = images.size()
@@ -86,14 +96,16 @@ def extract_image_patches(images, ksizes, strides, rates, padding='same'):
     return patches  # [N, C*k*k, L], L is the total number of such blocks
 
 
-def random_bbox(config, batch_size):
+def random_bbox(config, batch_size, generator=None):
     """Generate a random tlhw with configuration.
 
     Args:
         config: Config should have configuration including img
+        generator: torch.Generator for reproducible boxes, the boxes are
+            drawn on its device. Defaults to the global CPU generator.
 
     Returns:
-        tuple: (top, left, height, width)
+        torch.tensor: [batch_size, 4] int64 (top, left, height, width)
 
     """
     img_height, img_width, _ = config['image_shape']
@@ -101,19 +113,14 @@ def random_bbox(config, batch_size):
     margin_height, margin_width = config['margin']
     maxt = img_height - margin_height - h
     maxl = img_width - margin_width - w
-    bbox_list = []
-    if config['mask_batch_same']:
-        t = np.random.randint(margin_height, maxt)
-        l = np.random.randint(margin_width, maxl)
-        bbox_list.append((t, l, h, w))
-        bbox_list = bbox_list * batch_size
-    else:
-        for i in range(batch_size):
-            t = np.random.randint(margin_height, maxt)
-            l = np.random.randint(margin_width, maxl)
-            bbox_list.append((t, l, h, w))
+    device = generator.device if generator is not None else None
+    # one box for the whole batch, or one per sample
+    n = 1 if config['mask_batch_same'] else batch_size
+    t = torch.randint(margin_height, maxt, (n,), generator=generator, device=device)
+    l = torch.randint(margin_width, maxl, (n,), generator=generator, device=device)
+    bboxes = torch.stack([t, l, torch.full_like(t, h), torch.full_like(t, w)], dim=1)
 
-    return torch.tensor(bbox_list, dtype=torch.int64)
+    return bboxes.expand(batch_size, -1).contiguous()
 
 
 def test_random_bbox():
@@ -124,15 +131,35 @@ def test_random_bbox():
     return bbox
 
 
-def bbox2mask(bboxes, height, width, max_delta_h, max_delta_w):
+def bbox2mask(bboxes, height, width, max_delta_h, max_delta_w, generator=None, device=None):
+    """Masks of the boxes, each shrunk by random deltas on every side.
+
+    All the masks are built at once by comparing coordinate grids with
+    the box edges, directly on the target device.
+    Args:
+        bboxes: [N, 4] (top, left, height, width) tensor.
+        generator: torch.Generator for reproducible deltas, they are drawn
+            on its device. Defaults to the global CPU generator.
+        device: Device of the masks, defaults to the device of bboxes.
+    Returns:
+        torch.tensor: [N, 1, height, width] float32 masks
+    """
     batch_size = bboxes.size(0)
-    mask = torch.zeros((batch_size, 1, height, width), dtype=torch.float32)
-    for i in range(batch_size):
-        bbox = bboxes[i]
-        delta_h = np.random.randint(max_delta_h // 2 + 1)
-        delta_w = np.random.randint(max_delta_w // 2 + 1)
-        mask[i, :, bbox[0] + delta_h:bbox[0] + bbox[2] - delta_h, bbox[1] + delta_w:bbox[1] + bbox[3] - delta_w] = 1.
-    return mask
+    device = device or bboxes.device
+    gen_device = generator.device if generator is not None else None
+    delta_h = torch.randint(max_delta_h // 2 + 1, (batch_size,), generator=generator, device=gen_device)
+    delta_w = torch.randint(max_delta_w // 2 + 1, (batch_size,), generator=generator, device=gen_device)
+    bboxes = bboxes.to(device)
+    delta_h = delta_h.to(device)
+    delta_w = delta_w.to(device)
+    top = (bboxes[:, 0] + delta_h).view(batch_size, 1, 1, 1)
+    bottom = (bboxes[:, 0] + bboxes[:, 2] - delta_h).view(batch_size, 1, 1, 1)
+    left = (bboxes[:, 1] + delta_w).view(batch_size, 1, 1, 1)
+    right = (bboxes[:, 1] + bboxes[:, 3] - delta_w).view(batch_size, 1, 1, 1)
+    rows = torch.arange(height, device=device).view(1, 1, height, 1)
+    cols = torch.arange(width, device=device).view(1, 1, 1, width)
+    mask = (rows >= top) & (rows < bottom) & (cols >= left) & (cols < right)
+    return mask.to(torch.float32)
 
 
 def test_bbox2mask():
@@ -145,23 +172,162 @@ def test_bbox2mask():
     return mask
 
 
+def _patch_index(bbox_list, width, device):
+    """Flat [N, 1, h * w] indices of the pixels of the boxes in [N, C, H * width] images."""
+    bboxes = torch.as_tensor(bbox_list, dtype=torch.int64).to(device)
+    n = bboxes.size(0)
+    h, w = [int(v) for v in bboxes[0, 2:].tolist()]
+    rows = bboxes[:, 0].view(n, 1, 1) + torch.arange(h, device=device).view(1, h, 1)
+    cols = bboxes[:, 1].view(n, 1, 1) + torch.arange(w, device=device).view(1, 1, w)
+    return (rows * width + cols).view(n, 1, h * w), h, w
+
+
 def local_patch(x, bbox_list):
-    assert len(x.size()) == 4
-    patches = []
-    for i, bbox in enumerate(bbox_list):
-        t, l, h, w = bbox
-        patches.append(x[i, :, t:t + h, l:l + w])
-    return torch.stack(patches, dim=0)
+    """Crop the box of every sample.
 
+    On the GPU, the crops of every tensor are copied by a single indexing
+    kernel, see _index_patches, instead of one slice copy per sample. On
+    the CPU the crops are sliced, which only copies contiguous rows and
+    is faster there.
+    Args:
+        x: [N, C, H, W] tensor, or a list of them sharing the boxes.
+        bbox_list: [N, 4] (top, left, height, width) tensor or list, all
+            the boxes have the same size.
+    Returns:
+        [N, C, h, w] crops, or a list of them
+    """
+    xs = [x] if torch.is_tensor(x) else list(x)
+    for xi in xs:
+        assert len(xi.size()) == 4
+    bboxes = torch.as_tensor(bbox_list, dtype=torch.int64)
+    if xs[0].is_cuda:
+        patches = _index_patches(xs, bboxes)
+    else:
+        patches = _slice_patches(xs, bboxes)
+    return patches[0] if torch.is_tensor(x) else patches
+
+
+def _slice_patches(xs, bboxes):
+    """Crop the boxes of every tensor of xs, one slice per sample."""
+    boxes = bboxes.tolist()
+    return [torch.stack([xi[i, :, t:t + h, l:l + w] for i, (t, l, h, w) in enumerate(boxes)], dim=0)
+            for xi in xs]
 
-def mask_image(x, bboxes, config):
+
+def _index_patches(xs, bboxes):
+    """Crop the boxes of every tensor of xs with one advanced indexing each.
+
+    The [N, C, H - h + 1, W - w + 1, h, w] unfolded view of a tensor holds
+    every possible crop without a copy, indexing it at the (sample, top,
+    left) of the boxes copies the N crops and nothing else.
+    """
+    h, w = [int(v) for v in bboxes[0, 2:].tolist()]
+    bboxes = bboxes.to(xs[0].device)
+    batch = torch.arange(bboxes.size(0), device=bboxes.device)
+    return [xi.unfold(2, h, 1).unfold(3, w, 1)[batch, :, bboxes[:, 0], bboxes[:, 1]] for xi in xs]
+
+
+def test_local_patch(batch_size=48, size=256, patch_size=128):
+    x = torch.randn(batch_size, 3, size, size)
+    bboxes = torch.stack([torch.randint(0, size - patch_size, (batch_size,)),
+                          torch.randint(0, size - patch_size, (batch_size,)),
+                          torch.full((batch_size,), patch_size, dtype=torch.int64),
+                          torch.full((batch_size,), patch_size, dtype=torch.int64)], dim=1)
+    expected = torch.stack([x[i, :, t:t + h, l:l + w] for i, (t, l, h, w) in enumerate(bboxes.tolist())])
+    patch, patch_x2 = local_patch([x, x * 2.], bboxes)
+    assert torch.equal(patch, expected), 'local_patch does not match the slices'
+    assert torch.equal(patch_x2, expected * 2.), 'local_patch does not match the slices of every tensor'
+    assert torch.equal(local_patch(x, bboxes.tolist()), expected), 'local_patch does not accept box lists'
+    # the GPU path, on the CPU
+    patch, patch_x2 = _index_patches([x, x * 2.], bboxes)
+    assert torch.equal(patch, expected), 'The indexed crops do not match the slices'
+    assert torch.equal(patch_x2, expected * 2.), 'The indexed crops do not match the slices of every tensor'
+    return patch
+
+
+def brush_stroke_mask(height, width, brush, rng=np.random):
+    """Draw a free-form mask of random brush strokes.
+
+    Every stroke is a zig-zag polyline with random vertices, segment
+    lengths, angles and width, with round joints, as in:
+        Free-Form Image Inpainting with Gated Convolution, Yu et al.
+    Args:
+        brush: Config with the [min, max] ranges num_strokes, num_vertex
+            and width.
+        rng: numpy RandomState.
+    Returns:
+        np.ndarray: [height, width] uint8 mask, 1 in the strokes
+    """
+    mean_angle = 2 * math.pi / 5
+    angle_range = 2 * math.pi / 15
+    average_radius = math.sqrt(height ** 2 + width ** 2) / 8
+    mask = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(mask)
+    for _ in range(rng.randint(brush['num_strokes'][0], brush['num_strokes'][1] + 1)):
+        num_vertex = rng.randint(brush['num_vertex'][0], brush['num_vertex'][1] + 1)
+        angle_min = mean_angle - rng.uniform(0, angle_range)
+        angle_max = mean_angle + rng.uniform(0, angle_range)
+        angles = rng.uniform(angle_min, angle_max, num_vertex)
+        # zig-zag
+        angles[::2] = 2 * math.pi - angles[::2]
+        lengths = np.clip(rng.normal(average_radius, average_radius / 2, num_vertex), 0, 2 * average_radius)
+        vertices = [(rng.randint(0, width), rng.randint(0, height))]
+        for angle, length in zip(angles, lengths):
+            vx = np.clip(vertices[-1][0] + length * math.cos(angle), 0, width - 1)
+            vy = np.clip(vertices[-1][1] + length * math.sin(angle), 0, height - 1)
+            vertices.append((int(vx), int(vy)))
+        brush_width = int(rng.uniform(brush['width'][0], brush['width'][1]))
+        draw.line(vertices, fill=1, width=brush_width)
+        for vx, vy in vertices:
+            draw.ellipse((vx - brush_width // 2, vy - brush_width // 2,
+                          vx + brush_width // 2, vy + brush_width // 2), fill=1)
+    return np.asarray(mask, dtype=np.uint8)
+
+
+def free_form_mask(bboxes, height, width, config, generator=None, mask_bank=None, device=None):
+    """Masks of brush strokes, drawn inside the boxes.
+
+    The strokes stay in the boxes, so that the local discriminator still
+    sees the whole hole.
+    Args:
+        bboxes: [N, 4] (top, left, height, width) tensor, all the boxes
+            have the size config['mask_shape'].
+        generator: torch.Generator for reproducible masks.
+        mask_bank: data.mask_bank.MaskBank to sample the strokes from,
+            they are drawn with brush_stroke_mask otherwise (slow).
+        device: Device of the masks, defaults to the device of bboxes.
+    Returns:
+        torch.tensor: [N, 1, height, width] float32 masks
+    """
+    batch_size = bboxes.size(0)
+    device = device or bboxes.device
+    h, w = config['mask_shape']
+    if mask_bank is not None:
+        strokes = mask_bank.sample(batch_size, generator=generator, device=device)
+        assert strokes.size()[2:] == (h, w), 'The mask bank does not match mask_shape'
+    else:
+        seed = torch.randint(2 ** 31 - 1, (1,), generator=generator,
+                             device=generator.device if generator is not None else None).item()
+        rng = np.random.RandomState(seed)
+        strokes = np.stack([brush_stroke_mask(h, w, config['brush'], rng) for _ in range(batch_size)])
+        strokes = torch.from_numpy(strokes).to(device).unsqueeze(dim=1).to(torch.float32)
+    index, _, _ = _patch_index(bboxes, width, device)
+    mask = torch.zeros(batch_size, 1, height * width, device=device)
+    mask.scatter_(2, index, strokes.reshape(batch_size, 1, h * w))
+    return mask.view(batch_size, 1, height, width)
+
+
+def mask_image(x, bboxes, config, generator=None, mask_bank=None):
     height, width, _ = config['image_shape']
     max_delta_h, max_delta_w = config['max_delta_shape']
-    mask = bbox2mask(bboxes, height, width, max_delta_h, max_delta_w)
-    if x.is_cuda:
-        mask = mask.cuda()
+    # the mask is built on the device of x, only the boxes are copied
+    if config['mask_type'] == 'free_form':
+        mask = free_form_mask(bboxes, height, width, config, generator=generator, mask_bank=mask_bank,
+                              device=x.device)
+    else:
+        mask = bbox2mask(bboxes, height, width, max_delta_h, max_delta_w, generator=generator, device=x.device)
 
-    if config['mask_type'] == 'hole':
+    if config['mask_type'] in ('hole', 'free_form'):
         result = x * (1. - mask)
     elif config['mask_type'] == 'mosaic':
         # TODO: Matching the mosaic patch size and the mask size
@@ -175,38 +341,112 @@ def mask_image(x, bboxes, config):
     return result, mask
 
 
-def spatial_discounting_mask(config):
+def mask_components(mask):
+    """Label the connected holes (8-connectivity) of a batch of masks.
+
+    Vectorised label propagation: every hole pixel starts with its own
+    index as label, then repeatedly takes the largest label of its
+    neighbourhood and jumps to the label of the pixel that label points
+    to, until nothing changes.
+    :param mask: [N, 1, H, W] tensor, 1 in the holes
+    :return: [N, 1, H, W] int64 tensor, 0 outside the holes and the same
+     positive label for all the pixels of a connected hole
+    """
+    n, _, height, width = mask.size()
+    # float64 keeps the pixel indices exact for any image size
+    hole = (mask > 0.5).to(torch.float64)
+    labels = torch.arange(1, height * width + 1, dtype=torch.float64, device=mask.device)
+    labels = labels.view(1, 1, height, width) * hole
+    while True:
+        new_labels = F.max_pool2d(labels, 3, stride=1, padding=1) * hole
+        flat = new_labels.view(n, -1)
+        flat = torch.gather(flat, 1, torch.clamp(flat - 1, min=0).long())
+        new_labels = flat.view_as(labels) * hole
+        if torch.equal(new_labels, labels):
+            return labels.long()
+        labels = new_labels
+
+
+def mask_bboxes(labels):
+    """Bounding boxes of the labelled holes of every mask.
+
+    :param labels: [N, 1, H, W] output of mask_components
+    :return: list with a list of (top, left, height, width) per mask
+    """
+    bboxes = []
+    for label in labels:
+        boxes = []
+        for k in torch.unique(label).tolist():
+            if k == 0:
+                continue
+            ys, xs = torch.nonzero(label[0] == k, as_tuple=True)
+            t, l = ys.min().item(), xs.min().item()
+            boxes.append((t, l, ys.max().item() - t + 1, xs.max().item() - l + 1))
+        bboxes.append(boxes)
+    return bboxes
+
+
+def spatial_discounting_mask(config, bboxes=None, device=None):
     """Generate spatial discounting mask constant.
 
     Spatial discounting mask is first introduced in publication:
         Generative Image Inpainting with Contextual Attention, Yu et al.
 
+    The values are computed at once from coordinate grids.
     Args:
         config: Config should have configuration including HEIGHT, WIDTH,
             DISCOUNTED_MASK.
+        bboxes: Optional [N, 4] (top, left, height, width) boxes of
+            different sizes, for one mask per box. Every mask is at the
+            top left of a canvas of the largest box size and 0 outside
+            its box.
+        device: Device of the mask, defaults to cuda if config['cuda'].
 
     Returns:
-        tf.Tensor: spatial discounting mask
+        torch.tensor: [1, 1, height, width] spatial discounting mask of
+            config['mask_shape'], or [N, 1, max height, max width] with bboxes
 
     """
     gamma = config['spatial_discounting_gamma']
-    height, width = config['mask_shape']
-    shape = [1, 1, height, width]
+    if device is None:
+        device = 'cuda' if config['cuda'] else 'cpu'
+    if bboxes is None:
+        sizes = torch.tensor([config['mask_shape']], dtype=torch.int64, device=device)
+    else:
+        sizes = torch.as_tensor(bboxes, dtype=torch.int64).to(device)[:, 2:]
+    n = sizes.size(0)
+    height, width = [int(v) for v in sizes.max(dim=0)[0].tolist()]
+    box_h = sizes[:, 0].view(n, 1, 1, 1)
+    box_w = sizes[:, 1].view(n, 1, 1, 1)
+    rows = torch.arange(height, device=device).view(1, 1, height, 1)
+    cols = torch.arange(width, device=device).view(1, 1, 1, width)
+    inside = ((rows < box_h) & (cols < box_w)).to(torch.float64)
     if config['discounted_mask']:
-        mask_values = np.ones((height, width))
-        for i in range(height):
-            for j in range(width):
-                mask_values[i, j] = max(
-                    gamma ** min(i, height - i),
-                    gamma ** min(j, width - j))
-        mask_values = np.expand_dims(mask_values, 0)
-        mask_values = np.expand_dims(mask_values, 0)
+        # max(gamma ** min(i, height - i), gamma ** min(j, width - j))
+        mask_values = torch.max(torch.pow(gamma, torch.min(rows, box_h - rows).to(torch.float64)),
+                                torch.pow(gamma, torch.min(cols, box_w - cols).to(torch.float64))) * inside
     else:
-        mask_values = np.ones(shape)
-    spatial_discounting_mask_tensor = torch.tensor(mask_values, dtype=torch.float32)
-    if config['cuda']:
-        spatial_discounting_mask_tensor = spatial_discounting_mask_tensor.cuda()
-    return spatial_discounting_mask_tensor
+        mask_values = inside
+    return mask_values.to(torch.float32)
+
+
+def test_spatial_discounting_mask():
+    config = {'spatial_discounting_gamma': 0.9, 'mask_shape': [128, 96], 'discounted_mask': True, 'cuda': False}
+    gamma = config['spatial_discounting_gamma']
+    height, width = config['mask_shape']
+    expected = np.ones((1, 1, height, width))
+    for i in range(height):
+        for j in range(width):
+            expected[0, 0, i, j] = max(gamma ** min(i, height - i), gamma ** min(j, width - j))
+    mask = spatial_discounting_mask(config)
+    assert np.allclose(mask.numpy(), expected, rtol=1e-6), 'spatial_discounting_mask does not match the loop'
+    masks = spatial_discounting_mask(config, bboxes=[[0, 0, 128, 96], [10, 20, 64, 32]])
+    assert torch.equal(masks[:1], mask), 'spatial_discounting_mask does not match for the largest box'
+    small = spatial_discounting_mask(dict(config, mask_shape=[64, 32]))
+    assert torch.equal(masks[1:, :, :64, :32], small), 'spatial_discounting_mask does not match for a smaller box'
+    assert (masks[1, :, 64:] == 0).all() and (masks[1, :, :, 32:] == 0).all(), \
+        'spatial_discounting_mask is not 0 outside the box'
+    return masks
 
 
 def reduce_mean(x, axis=None, keepdim=False):
@@ -264,39 +504,23 @@ def flow_to_image(flow):
 
 def pt_flow_to_image(flow):
     """Transfer flow map to image.
-    Part of code forked from flownet.
+    Batched PyTorch version of flow_to_image, computed on the device of flow.
+    :param flow: [N, 2, H, W] flow tensor
+    :return: [N, 3, H, W] float tensor with the uint8 values of flow_to_image
     """
-    out = []
-    maxu = torch.tensor(-999)
-    maxv = torch.tensor(-999)
-    minu = torch.tensor(999)
-    minv = torch.tensor(999)
-    maxrad = torch.tensor(-1)
-    if torch.cuda.is_available():
-        maxu = maxu.cuda()
-        maxv = maxv.cuda()
-        minu = minu.cuda()
-        minv = minv.cuda()
-        maxrad = maxrad.cuda()
-    for i in range(flow.shape[0]):
-        u = flow[i, 0, :, :]
-        v = flow[i, 1, :, :]
-        idxunknow = (torch.abs(u) > 1e7) + (torch.abs(v) > 1e7)
-        u[idxunknow] = 0
-        v[idxunknow] = 0
-        maxu = torch.max(maxu, torch.max(u))
-        minu = torch.min(minu, torch.min(u))
-        maxv = torch.max(maxv, torch.max(v))
-        minv = torch.min(minv, torch.min(v))
-        rad = torch.sqrt((u ** 2 + v ** 2).float()).to(torch.int64)
-        maxrad = torch.max(maxrad, torch.max(rad))
-        u = u / (maxrad + torch.finfo(torch.float32).eps)
-        v = v / (maxrad + torch.finfo(torch.float32).eps)
-        # TODO: change the following to pytorch
-        img = pt_compute_color(u, v)
-        out.append(img)
-
-    return torch.stack(out, dim=0)
+    flow = flow.to(torch.float64)
+    u = flow[:, 0]
+    v = flow[:, 1]
+    idxunknow = (torch.abs(u) > 1e7) | (torch.abs(v) > 1e7)
+    u = u.masked_fill(idxunknow, 0)
+    v = v.masked_fill(idxunknow, 0)
+    rad = torch.sqrt(u ** 2 + v ** 2)
+    # like flow_to_image, every sample is scaled by the largest radius seen so far in the batch
+    maxrad = torch.cummax(rad.view(rad.size(0), -1).max(dim=1)[0], dim=0)[0].view(-1, 1, 1)
+    u = u / (maxrad + np.finfo(float).eps)
+    v = v / (maxrad + np.finfo(float).eps)
+    img = pt_compute_color(u, v)
+    return img.to(torch.float32)
 
 
 def highlight_flow(flow):
@@ -308,31 +532,24 @@ def highlight_flow(flow):
         img = np.ones((s[1], s[2], 3)) * 144.
         u = flow[i, :, :, 0]
         v = flow[i, :, :, 1]
-        for h in range(s[1]):
-            for w in range(s[1]):
-                ui = u[h, w]
-                vi = v[h, w]
-                img[ui, vi, :] = 255.
+        img[u, v, :] = 255.
         out.append(img)
     return np.float32(np.uint8(out))
 
 
 def pt_highlight_flow(flow):
     """Convert flow into middlebury color code image.
-        """
-    out = []
-    s = flow.shape
-    for i in range(flow.shape[0]):
-        img = np.ones((s[1], s[2], 3)) * 144.
-        u = flow[i, :, :, 0]
-        v = flow[i, :, :, 1]
-        for h in range(s[1]):
-            for w in range(s[1]):
-                ui = u[h, w]
-                vi = v[h, w]
-                img[ui, vi, :] = 255.
-        out.append(img)
-    return np.float32(np.uint8(out))
+    Batched PyTorch version of highlight_flow, with channels first.
+    :param flow: [N, 2, H, W] integer flow tensor
+    :return: [N, 3, H, W] float tensor
+    """
+    n, _, h, w = flow.size()
+    flow = flow.long()
+    # negative positions wrap around like NumPy indexing
+    idx = torch.remainder(flow[:, 0], h) * w + torch.remainder(flow[:, 1], w)
+    img = torch.full((n, 3, h * w), 144., device=flow.device)
+    img.scatter_(2, idx.view(n, 1, -1).expand(-1, 3, -1), 255.)
+    return img.view(n, 3, h, w)
 
 
 def compute_color(u, v):
@@ -365,35 +582,29 @@ def compute_color(u, v):
 
 
 def pt_compute_color(u, v):
-    h, w = u.shape
-    img = torch.zeros([3, h, w])
-    if torch.cuda.is_available():
-        img = img.cuda()
-    nanIdx = (torch.isnan(u) + torch.isnan(v)) != 0
-    u[nanIdx] = 0.
-    v[nanIdx] = 0.
-    # colorwheel = COLORWHEEL
-    colorwheel = pt_make_color_wheel()
-    if torch.cuda.is_available():
-        colorwheel = colorwheel.cuda()
-    ncols = colorwheel.size()[0]
-    rad = torch.sqrt((u ** 2 + v ** 2).to(torch.float32))
-    a = torch.atan2(-v.to(torch.float32), -u.to(torch.float32)) / np.pi
+    """Batched PyTorch version of compute_color.
+    :param u: [N, H, W] float tensor
+    :param v: [N, H, W] float tensor
+    :return: [N, 3, H, W] tensor with the uint8 values of compute_color
+    """
+    nanIdx = torch.isnan(u) | torch.isnan(v)
+    u = u.masked_fill(nanIdx, 0.)
+    v = v.masked_fill(nanIdx, 0.)
+    colorwheel = pt_make_color_wheel(u.device, u.dtype)
+    ncols = colorwheel.size(0)
+    rad = torch.sqrt(u ** 2 + v ** 2).unsqueeze(1)
+    a = torch.atan2(-v, -u) / np.pi
     fk = (a + 1) / 2 * (ncols - 1) + 1
     k0 = torch.floor(fk).to(torch.int64)
     k1 = k0 + 1
-    k1[k1 == ncols + 1] = 1
-    f = fk - k0.to(torch.float32)
-    for i in range(colorwheel.size()[1]):
-        tmp = colorwheel[:, i]
-        col0 = tmp[k0 - 1]
-        col1 = tmp[k1 - 1]
-        col = (1 - f) * col0 + f * col1
-        idx = rad <= 1. / 255.
-        col[idx] = 1 - rad[idx] * (1 - col[idx])
-        notidx = (idx != 0)
-        col[notidx] *= 0.75
-        img[i, :, :] = col * (1 - nanIdx).to(torch.float32)
+    k1 = torch.where(k1 == ncols + 1, torch.ones_like(k1), k1)
+    f = (fk - k0.to(fk.dtype)).unsqueeze(1)
+    # look up all the color channels at once: [N, H, W, 3] -> [N, 3, H, W]
+    col0 = colorwheel[k0 - 1].permute(0, 3, 1, 2) / 255
+    col1 = colorwheel[k1 - 1].permute(0, 3, 1, 2) / 255
+    col = (1 - f) * col0 + f * col1
+    col = torch.where(rad <= 1, 1 - rad * (1 - col), col * 0.75)
+    img = torch.floor(255 * col * (1 - nanIdx.unsqueeze(1).to(col.dtype)))
     return img
 
 
@@ -428,35 +639,17 @@ def make_color_wheel():
     return colorwheel
 
 
-def pt_make_color_wheel():
-    RY, YG, GC, CB, BM, MR = (15, 6, 4, 11, 13, 6)
-    ncols = RY + YG + GC + CB + BM + MR
-    colorwheel = torch.zeros([ncols, 3])
-    col = 0
-    # RY
-    colorwheel[0:RY, 0] = 1.
-    colorwheel[0:RY, 1] = torch.arange(0, RY, dtype=torch.float32) / RY
-    col += RY
-    # YG
-    colorwheel[col:col + YG, 0] = 1. - (torch.arange(0, YG, dtype=torch.float32) / YG)
-    colorwheel[col:col + YG, 1] = 1.
-    col += YG
-    # GC
-    colorwheel[col:col + GC, 1] = 1.
-    colorwheel[col:col + GC, 2] = torch.arange(0, GC, dtype=torch.float32) / GC
-    col += GC
-    # CB
-    colorwheel[col:col + CB, 1] = 1. - (torch.arange(0, CB, dtype=torch.float32) / CB)
-    colorwheel[col:col + CB, 2] = 1.
-    col += CB
-    # BM
-    colorwheel[col:col + BM, 2] = 1.
-    colorwheel[col:col + BM, 0] = torch.arange(0, BM, dtype=torch.float32) / BM
-    col += BM
-    # MR
-    colorwheel[col:col + MR, 2] = 1. - (torch.arange(0, MR, dtype=torch.float32) / MR)
-    colorwheel[col:col + MR, 0] = 1.
-    return colorwheel
+_COLOR_WHEELS = {}
+
+
+def pt_make_color_wheel(device=None, dtype=torch.float64):
+    """The color wheel of make_color_wheel as a tensor, cached per device and dtype."""
+    key = (str(device), dtype)
+    if key not in _COLOR_WHEELS:
+        colorwheel = torch.from_numpy(make_color_wheel())
+        _COLOR_WHEELS[key] = colorwheel.to(device=device, dtype=dtype)
+    return _COLOR_WHEELS[key]
+
 
 
 def is_image_file(filename):
@@ -470,6 +663,14 @@ def deprocess(img):
     return img
 
 
+def test_pt_flow_to_image():
+    flow = torch.randint(-32, 32, (4, 2, 32, 32))
+    expected = flow_to_image(flow.permute(0, 2, 3, 1).numpy().copy())
+    img = pt_flow_to_image(flow).permute(0, 2, 3, 1).numpy()
+    assert np.array_equal(img, expected), 'pt_flow_to_image does not match flow_to_image'
+    return img
+
+
 # get configs
 def get_config(config):
     with open(config, 'r') as stream: